@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Benchmark of compiled rendering of wide document forms.
+
+Renders bound forms of a document with ``--fields`` fields generated by
+`fields_for_document` with compiled rendering and with Django's
+`BaseForm._html_output` and checks that the output is the same::
+
+    python benchmarks/formrendering.py --fields 60 --number 200
+
+No database connection is needed.
+"""
+import os
+import sys
+import timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+settings.configure(USE_I18N=True)
+
+from mongoengine import Document
+from mongoengine.fields import (StringField, IntField, FloatField,
+                                BooleanField, DateTimeField, EmailField)
+
+from mongotools.forms import documentform_factory
+
+FIELD_TYPES = [
+    lambda i: StringField(max_length=100, required=True),
+    lambda i: IntField(min_value=0, help_text=u'Number %d' % i),
+    lambda i: FloatField(),
+    lambda i: BooleanField(),
+    lambda i: DateTimeField(help_text=u'Date of <%d>' % i),
+    lambda i: EmailField(),
+    lambda i: StringField(choices=[('a', 'A'), ('b', 'B'), ('c', 'C')]),
+]
+
+
+
+def make_document(count):
+    attrs = {'__module__': __name__}
+    for i in range(count):
+        attrs['field_%s' % i] = FIELD_TYPES[i % len(FIELD_TYPES)](i)
+    return type('Wide%sDocument' % count, (Document,), attrs)
+
+def make_data(count):
+    # every tenth field is invalid, so errors are rendered too
+    data = {}
+    for i in range(count):
+        if i % 10:
+            data['field_%s' % i] = [u'text', u'1', u'1.5', u'on',
+                                    u'2012-01-01 10:00', u'a@example.com',
+                                    u'b'][i % len(FIELD_TYPES)]
+    return data
+
+def make_form_classes(document):
+    compiled = documentform_factory(document)
+    plain = type('Plain' + compiled.__name__, (compiled,),
+                 {'compiled_rendering': False})
+    return compiled, plain
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--fields', type='int', default=60)
+    parser.add_option('--number', type='int', default=200)
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+
+    document = make_document(options.fields)
+    data = make_data(options.fields)
+    compiled, plain = make_form_classes(document)
+
+    for method in ('as_table', 'as_p', 'as_ul'):
+        forms = [form_class(data) for form_class in (compiled, plain)]
+        for form in forms:
+            form.is_valid()
+        outputs = [getattr(form, method)() for form in forms]
+        assert outputs[0] == outputs[1], 'Different %s output' % method
+
+    print '%s fields, %s renders of as_table (best of %s):' % (
+        options.fields, options.number, options.repeat)
+    results = {}
+    for name, form_class in (('django', plain), ('compiled', compiled)):
+        form = form_class(data)
+        form.is_valid()
+        results[name] = min(timeit.repeat(form.as_table,
+                                          repeat=options.repeat,
+                                          number=options.number))
+        print '  %-8s %.3fs (%.2fms per render)' % (
+            name, results[name], results[name] * 1000 / options.number)
+    print '  speedup  %.2fx' % (results['django'] / results['compiled'])
+
+if __name__ == '__main__':
+    main()
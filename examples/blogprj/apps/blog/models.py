@@ -1,11 +1,12 @@
 from datetime import datetime
 
-from django.template.defaultfilters import slugify
 from django.core.urlresolvers import reverse
 from django.db.models import permalink
 
 from mongoengine import *
 
+from mongotools.slugs import UniqueSlugMixin
+
 class Tag(Document):
     tag = StringField(max_length=100, required=True)
     created = DateTimeField()
@@ -32,33 +33,17 @@ class Tag(Document):
     }
     
 
-class BlogPost(Document):
+class BlogPost(UniqueSlugMixin, Document):
     published = BooleanField(default=False)
     author = StringField(required=True)
     title = StringField(required=True)
-    slug = StringField()
+    slug = StringField(unique=True)
     content = StringField(required=True)
     
     tags = ListField(ReferenceField(Tag))
     
     datetime_added = DateTimeField(default=datetime.now)
     
-    def save(self):
-        if self.slug is None:
-            slug = slugify(self.title)
-            new_slug = slug
-            c = 1
-            while True:
-                try:
-                    BlogPost.objects.get(slug=new_slug)
-                except BlogPost.DoesNotExist:
-                    break
-                else:
-                    c += 1
-                    new_slug = '%s-%s' % (slug, c)
-            self.slug = new_slug
-        return super(BlogPost, self).save()
-    
     def get_absolute_url(self):
         return '/%s/' % str(self.pk)
     
@@ -0,0 +1,77 @@
+try:
+    from pymongo import ReturnDocument
+except ImportError:
+    # pymongo < 3
+    ReturnDocument = None
+from inspect import getargspec
+
+from mongoengine import Document
+
+# mongoengine < 0.8 takes ``safe`` and ``write_options`` instead
+_save_write_concern = 'write_concern' in getargspec(Document.save).args
+
+
+
+def find_one_and_update(collection, spec, update, **kwargs):
+    """
+    Atomically updates a single document matching ``spec`` and returns
+    its new version (or ``None`` if nothing matched).
+    """
+    if ReturnDocument is not None:
+        return collection.find_one_and_update(
+            spec, update, return_document=ReturnDocument.AFTER, **kwargs)
+    return collection.find_and_modify(spec, update, new=True, **kwargs)
+
+def update_one(collection, spec, update):
+    if hasattr(collection, 'update_one'):
+        # pymongo 3+
+        return collection.update_one(spec, update)
+    return collection.update(spec, update, multi=False)
+
+def update_many(collection, spec, update):
+    if hasattr(collection, 'update_many'):
+        # pymongo 3+
+        return collection.update_many(spec, update)
+    return collection.update(spec, update, multi=True)
+
+def delete_many(collection, spec):
+    if hasattr(collection, 'delete_many'):
+        # pymongo 3+
+        return collection.delete_many(spec)
+    return collection.remove(spec)
+
+def insert_many(collection, docs, ordered=True):
+    if hasattr(collection, 'insert_many'):
+        # pymongo 3+
+        return collection.insert_many(docs, ordered=ordered)
+    return collection.insert(docs, continue_on_error=not ordered)
+
+def count_sliced(queryset):
+    """Returns number of documents of ``queryset`` within its slice."""
+    if 'with_limit_and_skip' in getargspec(queryset.count).args:
+        return queryset.count(with_limit_and_skip=True)
+    # mongoengine < 0.9 ignores the limit and skip
+    if getattr(queryset, '_limit', None) == 0:
+        return 0
+    return queryset.clone()._cursor.count(with_limit_and_skip=True)
+
+def write_concern_kwargs(write_concern):
+    """
+    Returns `Document.save` keyword arguments for ``write_concern`` dict
+    (e.g. ``{'w': 0}`` or ``{'w': 1, 'j': True}``).
+    """
+    if write_concern is None:
+        return {}
+    if _save_write_concern:
+        return {'write_concern': write_concern}
+    if not write_concern.get('w', 1):
+        return {'safe': False}
+    return {'safe': True, 'write_options': dict(write_concern)}
+
+def aggregate(collection, pipeline):
+    """Returns a list of result documents of aggregation ``pipeline``."""
+    result = collection.aggregate(pipeline)
+    if isinstance(result, dict):
+        # pymongo < 3
+        return result['result']
+    return list(result)
@@ -0,0 +1,97 @@
+"""
+Content-addressed deduplication of GridFS files.
+
+Deduplicated files are stored with SHA-256 hash of their content and
+a reference count in ``fs.files``. Saving a file whose content is already
+stored increments the reference count of the existing file instead of
+writing a new one; `release_file` decrements it and deletes the file
+once it is not referenced anymore.
+"""
+import hashlib
+from datetime import datetime
+
+from gridfs import GridFS
+from mongoengine.connection import get_db
+
+from django.conf import settings
+
+from mongotools.compat import find_one_and_update
+
+HASH_KEY = 'sha256'
+REFCOUNT_KEY = 'refcount'
+# time of the last reuse, files reused recently are not collected as orphans
+ACQUIRED_KEY = 'acquiredDate'
+
+
+
+def is_dedup_enabled(dedup=None):
+    if dedup is None:
+        return getattr(settings, 'MONGOTOOLS_FILE_DEDUP', False)
+    return dedup
+
+def dedup_file_attrs(digest):
+    """Returns ``fs.files`` attributes of a new deduplicated file."""
+    return {HASH_KEY: digest, REFCOUNT_KEY: 1}
+
+_indexed_collections = set()
+
+def _get_files(db_alias, collection_name):
+    files = get_db(db_alias)[collection_name].files
+    key = (db_alias, collection_name)
+    if key not in _indexed_collections:
+        files.create_index(HASH_KEY, sparse=True)
+        _indexed_collections.add(key)
+    return files
+
+def get_file_hash(proxy, file):
+    """
+    Returns SHA-256 hex digest of uploaded ``file``. Hash computed while
+    streaming the upload by `GridFSUploadHandler` is used if available.
+    """
+    digest = getattr(file, HASH_KEY, None)
+    if digest:
+        return digest
+    sha = hashlib.sha256()
+    for chunk in file.chunks():
+        sha.update(chunk)
+    return sha.hexdigest()
+
+def acquire_file(proxy, digest):
+    """
+    Increments reference count of stored file with ``digest`` content hash
+    and returns its id, or ``None`` if no such file is stored.
+    """
+    doc = find_one_and_update(_get_files(proxy.db_alias, proxy.collection_name),
+                              {HASH_KEY: digest, REFCOUNT_KEY: {'$gt': 0}},
+                              {'$inc': {REFCOUNT_KEY: 1},
+                               '$set': {ACQUIRED_KEY: datetime.utcnow()}})
+    return doc['_id'] if doc is not None else None
+
+def release_file_id(db_alias, collection_name, grid_id):
+    """
+    Decrements reference count of ``grid_id`` file. The file is deleted if
+    it is not referenced anymore or if it is not deduplicated. Returns
+    ``True`` if the file was deleted.
+    """
+    doc = find_one_and_update(_get_files(db_alias, collection_name),
+                              {'_id': grid_id, REFCOUNT_KEY: {'$exists': True}},
+                              {'$inc': {REFCOUNT_KEY: -1}})
+    if doc is None or doc[REFCOUNT_KEY] <= 0:
+        GridFS(get_db(db_alias), collection_name).delete(grid_id)
+        return True
+    return False
+
+def release_file(proxy):
+    """
+    Detaches the file from ``proxy`` and releases it with `release_file_id`.
+    Returns ``True`` if the file was deleted.
+    """
+    if not proxy.grid_id:
+        return False
+    deleted = release_file_id(proxy.db_alias, proxy.collection_name,
+                              proxy.grid_id)
+    proxy.grid_id = None
+    proxy.gridout = None
+    if hasattr(proxy, '_mark_as_changed'):
+        proxy._mark_as_changed()
+    return deleted
@@ -0,0 +1,216 @@
+import hashlib
+from datetime import datetime
+from uuid import uuid4
+
+from bson import DBRef, SON, json_util
+from mongoengine import signals
+from mongoengine.fields import ListField, ReferenceField
+
+from django.core.cache import cache
+from django.utils.encoding import force_unicode
+
+from mongotools.compat import aggregate
+from mongotools.tenancy import route_queryset
+
+__all__ = ('TermsFacet', 'DateFacet', 'get_facet_counts', 'invalidate_facets')
+
+FACETS_KEY = 'mongotools:facets:%s'
+FACETS_VERSION_KEY = 'mongotools:facets_version:%s'
+FACETS_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+
+class Facet(object):
+    """
+    Base class of facets counting documents per value of ``field``.
+    Results are lists of dicts with ``value``, ``label`` and ``count`` keys.
+    """
+
+    def __init__(self, field, name=None):
+        self.field = field
+        self.name = name or field
+
+    def get_field(self, document):
+        return document._fields[self.field]
+
+    def get_pipeline(self, document):
+        """Returns ``$facet`` sub-pipeline stages of this facet."""
+        raise NotImplementedError
+
+    def get_results(self, document, rows):
+        """Returns results for ``rows`` of the sub-pipeline."""
+        raise NotImplementedError
+
+    def get_collections(self, document):
+        """
+        Returns names of collections other than the document collection
+        the results depend on.
+        """
+        return []
+
+
+class TermsFacet(Facet):
+    """
+    Counts documents per value of a field, e.g. a choice field or (a list
+    of) references. Values are ordered by count, at most ``limit`` values
+    are returned. Referenced documents are labeled with a single query.
+    """
+
+    def __init__(self, field, name=None, limit=None):
+        super(TermsFacet, self).__init__(field, name)
+        self.limit = limit
+
+    def get_pipeline(self, document):
+        f = self.get_field(document)
+        path = '$' + f.db_field
+        stages = []
+        if isinstance(f, ListField):
+            stages.append({'$unwind': path})
+        stages.append({'$group': {'_id': path, 'count': {'$sum': 1}}})
+        stages.append({'$sort': SON([('count', -1), ('_id', 1)])})
+        if self.limit:
+            stages.append({'$limit': self.limit})
+        return stages
+
+    def _get_item_field(self, document):
+        f = self.get_field(document)
+        if isinstance(f, ListField) and f.field is not None:
+            return f.field
+        return f
+
+    def get_results(self, document, rows):
+        f = self._get_item_field(document)
+        values = [row['_id'] for row in rows]
+        if isinstance(f, ReferenceField):
+            values = [v.id if isinstance(v, DBRef) else v for v in values]
+            docs = route_queryset(f.document_type.objects).in_bulk(
+                [v for v in values if v is not None])
+            labels = dict((pk, force_unicode(doc))
+                          for pk, doc in docs.items())
+        elif f.choices:
+            labels = dict(c if isinstance(c, (list, tuple)) else (c, c)
+                          for c in f.choices)
+        else:
+            labels = {}
+        return [{'value': value,
+                 'label': labels.get(value, force_unicode(value)),
+                 'count': row['count']}
+                for value, row in zip(values, rows)]
+
+    def get_collections(self, document):
+        f = self._get_item_field(document)
+        if isinstance(f, ReferenceField):
+            return [f.document_type._get_collection_name()]
+        return []
+
+
+class DateFacet(Facet):
+    """
+    Counts documents per ``year``, ``month`` or ``day`` (``interval``) of
+    a date field, newest first. Values are `datetime` instances of the
+    first day of the buckets.
+    """
+    intervals = {
+        'year': (('year', '$year'),),
+        'month': (('year', '$year'), ('month', '$month')),
+        'day': (('year', '$year'), ('month', '$month'),
+                ('day', '$dayOfMonth')),
+    }
+    label_formats = {'year': '%Y', 'month': '%Y-%m', 'day': '%Y-%m-%d'}
+
+    def __init__(self, field, name=None, interval='month'):
+        super(DateFacet, self).__init__(field, name)
+        if interval not in self.intervals:
+            raise ValueError('Unknown date facet interval "%s"' % interval)
+        self.interval = interval
+
+    def get_pipeline(self, document):
+        db_field = self.get_field(document).db_field
+        key = SON((part, {operator: '$' + db_field})
+                  for part, operator in self.intervals[self.interval])
+        return [{'$match': {db_field: {'$ne': None}}},
+                {'$group': {'_id': key, 'count': {'$sum': 1}}},
+                {'$sort': {'_id': -1}}]
+
+    def get_results(self, document, rows):
+        results = []
+        for row in rows:
+            value = datetime(row['_id']['year'], row['_id'].get('month', 1),
+                             row['_id'].get('day', 1))
+            results.append({
+                'value': value,
+                'label': value.strftime(self.label_formats[self.interval]),
+                'count': row['count']})
+        return results
+
+
+def get_facets_version(collection_name):
+    """
+    Returns current version of cached facet counts depending on documents
+    stored in ``collection_name``.
+    """
+    key = FACETS_VERSION_KEY % collection_name
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, FACETS_VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+def invalidate_facets(collection_name):
+    cache.set(FACETS_VERSION_KEY % collection_name, uuid4().hex,
+              FACETS_VERSION_TIMEOUT)
+
+def _invalidate_facets_handler(sender, document=None, **kwargs):
+    # all collections are invalidated, as facets may be computed by
+    # other processes
+    collection_name = getattr(sender, '_get_collection_name', lambda: None)()
+    if collection_name:
+        invalidate_facets(collection_name)
+
+if signals.signals_available:
+    signals.post_save.connect(_invalidate_facets_handler)
+    signals.post_delete.connect(_invalidate_facets_handler)
+
+def get_facet_counts(queryset, facets, timeout=None):
+    """
+    Returns a dict of facet name -> results of ``facets`` for documents
+    matching ``queryset``, computed with a single ``$facet`` aggregation
+    (MongoDB 3.4+).
+
+    Results are cached per query for ``timeout`` seconds and invalidated
+    by ``post_save`` and ``post_delete`` signals of the document class and
+    of referenced document classes (requires blinker). Bulk updates do not
+    send signals, use `invalidate_facets` after them.
+    """
+    if not facets:
+        return {}
+    document = queryset._document
+    collection = queryset._collection
+    collection_name = document._get_collection_name()
+    query = queryset._query
+
+    collections = set([collection_name])
+    for facet in facets:
+        collections.update(facet.get_collections(document))
+    versions = [get_facets_version(name) for name in sorted(collections)]
+    # versions are not available without Django cache
+    cached = None not in versions
+    if cached:
+        spec = json_util.dumps([query, [(f.__class__.__name__, f.__dict__)
+                                        for f in facets]], sort_keys=True)
+        key = FACETS_KEY % hashlib.md5(
+            ':'.join([collection.full_name, spec] + versions)).hexdigest()
+        results = cache.get(key)
+        if results is not None:
+            return results
+
+    pipeline = [
+        {'$match': query},
+        {'$facet': dict((f.name, f.get_pipeline(document)) for f in facets)},
+    ]
+    rows = aggregate(collection, pipeline)[0]
+    results = dict((f.name, f.get_results(document, rows[f.name]))
+                   for f in facets)
+    if cached:
+        cache.set(key, results, timeout)
+    return results
@@ -0,0 +1,190 @@
+import os
+import mmap
+import time
+import calendar
+import tempfile
+
+from django.conf import settings
+from django.http import HttpResponse
+try:
+    from django.http import FileResponse
+except ImportError:
+    # Django < 1.8
+    FileResponse = None
+
+__all__ = ('LocalFileCache', 'get_default_file_cache')
+
+
+
+class LocalFileCache(object):
+    """
+    Read-through, size-bounded LRU cache of GridFS files on local disk.
+
+    Files are keyed by file id and md5 (or upload date), so changed files
+    are never served from the cache. Least recently used files are evicted
+    when total size of cached files exceeds ``max_size`` bytes; files
+    larger than ``max_file_size`` are not cached.
+
+    Cached files are served from memory maps or, for whole file responses,
+    with the ``sendfile`` path: either by the front-end web server if
+    ``sendfile_header`` (``X-Sendfile`` or ``X-Accel-Redirect`` with
+    ``sendfile_url`` prefix) is set, or by the WSGI server file wrapper
+    (Django 1.8+).
+
+    Files used less than ``in_use_timeout`` seconds ago are not evicted,
+    so the front-end web server can still open files passed to it with
+    ``sendfile_header``. Other responses read from files opened before
+    they are returned.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, directory, max_size=1024 ** 3, max_file_size=None,
+                 sendfile_header=None, sendfile_url=None, in_use_timeout=60):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_file_size = max_file_size or max_size // 10
+        self.sendfile_header = sendfile_header
+        self.sendfile_url = sendfile_url
+        self.in_use_timeout = in_use_timeout
+        # approximate total size, recalculated on eviction
+        self.size = None
+
+    def accepts(self, grid_out):
+        return grid_out.length <= self.max_file_size
+
+    def get_key(self, grid_out):
+        version = getattr(grid_out, 'md5', None) or int(
+            calendar.timegm(grid_out.upload_date.utctimetuple()))
+        return '%s-%s' % (grid_out._id, version)
+
+    def open(self, grid_out):
+        """
+        Returns ``(path, file)`` tuple of cached ``grid_out`` file opened for
+        reading, fetching it from GridFS if it is not cached yet. The open
+        file stays readable even if it is evicted meanwhile.
+        """
+        key = self.get_key(grid_out)
+        path = os.path.join(self.directory, key[-2:], key)
+        try:
+            # update mtime used for LRU eviction
+            os.utime(path, None)
+            return path, open(path, 'rb')
+        except (OSError, IOError):
+            # not cached or evicted meanwhile
+            pass
+
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created concurrently
+                pass
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                grid_out.seek(0)
+                while True:
+                    data = grid_out.read(self.chunk_size)
+                    if not data:
+                        break
+                    f.write(data)
+            finally:
+                f.close()
+            # opened before it can be evicted
+            f = open(tmp_path, 'rb')
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        if self.size is not None:
+            self.size += grid_out.length
+        if self.size is None or self.size > self.max_size:
+            self.evict()
+        return path, f
+
+    def evict(self):
+        """
+        Removes least recently used files exceeding ``max_size``, except
+        files used less than ``in_use_timeout`` seconds ago.
+        """
+        in_use_since = time.time() - self.in_use_timeout
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        for mtime, file_size, path in entries:
+            if size <= self.max_size or mtime >= in_use_since:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            size -= file_size
+        self.size = size
+
+    def stream(self, f, start, length):
+        """
+        Yields ``length`` bytes of cached file ``f`` (returned by `open`)
+        starting at ``start`` from a memory map of the file and closes it.
+        """
+        try:
+            if length <= 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                end = start + length
+                while start < end:
+                    yield mm[start:min(start + self.chunk_size, end)]
+                    start += self.chunk_size
+            finally:
+                mm.close()
+        finally:
+            f.close()
+
+    def sendfile_response(self, path, f):
+        """
+        Returns a whole file response of cached file ``f`` at ``path``
+        (returned by `open`) served with ``sendfile`` or ``None`` if it is
+        not available.
+        """
+        if self.sendfile_header:
+            # opened by the front-end web server
+            f.close()
+            response = HttpResponse()
+            if self.sendfile_url is not None:
+                relative = os.path.relpath(path, self.directory)
+                response[self.sendfile_header] = (
+                    self.sendfile_url + relative.replace(os.sep, '/'))
+            else:
+                response[self.sendfile_header] = path
+            return response
+        if FileResponse is not None:
+            return FileResponse(f)
+        return None
+
+_default_cache = None
+
+def get_default_file_cache():
+    """
+    Returns `LocalFileCache` configured with ``MONGOTOOLS_FILE_CACHE``
+    setting (a dict of `LocalFileCache` arguments) or ``None``.
+    """
+    global _default_cache
+    options = getattr(settings, 'MONGOTOOLS_FILE_CACHE', None)
+    if not options:
+        return None
+    if _default_cache is None:
+        _default_cache = LocalFileCache(**options)
+    return _default_cache
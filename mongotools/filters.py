@@ -0,0 +1,170 @@
+import re
+import warnings
+
+from mongoengine import Q, ValidationError as MongoValidationError
+from mongoengine.fields import ListField, ReferenceField
+
+from django import forms
+from django.core.exceptions import ImproperlyConfigured
+from django.core.validators import EMPTY_VALUES
+
+from mongotools.forms.fields import default_generator
+
+__all__ = ('UnindexedFilterWarning', 'compile_filters', 'compile_search',
+           'check_filter_indexes')
+
+FILTER_OPERATORS = ('ne', 'lt', 'lte', 'gt', 'gte', 'in', 'nin')
+MULTIPLE_VALUE_OPERATORS = ('in', 'nin')
+
+
+class UnindexedFilterWarning(UserWarning):
+    pass
+
+
+def split_lookup(lookup):
+    """Returns ``(field_name, operator)`` of ``field__operator`` lookup."""
+    name, sep, operator = lookup.rpartition('__')
+    if sep and operator in FILTER_OPERATORS:
+        return name, operator
+    return lookup, None
+
+def get_item_field(document, name):
+    """Returns document field ``name`` or its item field for lists."""
+    try:
+        f = document._fields[name]
+    except KeyError:
+        raise ImproperlyConfigured(u"Unknown filter field '%s' of %s"
+                                   % (name, document.__name__))
+    if isinstance(f, ListField) and f.field is not None:
+        f = f.field
+    return f
+
+# (document, field name) -> form field used to clean filter values
+_formfields = {}
+
+def clean_filter_value(document, name, value):
+    """
+    Converts GET parameter ``value`` to the python value of ``name``
+    field. Values are cleaned by form fields generated by the default
+    `DocumentFormFieldGenerator`, except references which are converted
+    to primary keys without fetching referenced documents.
+    Raises `forms.ValidationError` for invalid values.
+    """
+    f = get_item_field(document, name)
+    if isinstance(f, ReferenceField):
+        id_field = f.document_type._fields[f.document_type._meta['id_field']]
+        try:
+            value = id_field.to_python(value)
+            id_field.validate(value)
+        except (MongoValidationError, ValueError, TypeError):
+            raise forms.ValidationError(u"Invalid value '%s'" % value)
+        return value
+
+    key = (document, name)
+    formfield = _formfields.get(key)
+    if formfield is None:
+        try:
+            formfield = default_generator.generate(f)
+        except NotImplementedError:
+            raise ImproperlyConfigured(u"Filtering by %s field '%s' is not"
+                                       u" supported" % (f.__class__.__name__,
+                                                        name))
+        formfield.required = False
+        _formfields[key] = formfield
+    return formfield.clean(value)
+
+def compile_filters(document, filter_fields, data):
+    """
+    Returns ``(query, errors)`` tuple of `QuerySet.filter` keyword
+    arguments for ``filter_fields`` lookups (field names optionally
+    suffixed with ``__<operator>``) with values in ``data`` (GET
+    parameters named like the lookups) and a dict of error messages of
+    invalid parameters, which are skipped.
+    """
+    query = {}
+    errors = {}
+    for lookup in filter_fields:
+        name, operator = split_lookup(lookup)
+        if operator in MULTIPLE_VALUE_OPERATORS:
+            if hasattr(data, 'getlist'):
+                values = data.getlist(lookup)
+            else:
+                values = data.get(lookup) or []
+            values = [v for v in values if v not in EMPTY_VALUES]
+            if not values:
+                continue
+        else:
+            value = data.get(lookup)
+            if value in EMPTY_VALUES:
+                continue
+        try:
+            if operator in MULTIPLE_VALUE_OPERATORS:
+                value = [clean_filter_value(document, name, v) for v in values]
+            else:
+                value = clean_filter_value(document, name, value)
+        except forms.ValidationError, e:
+            errors[lookup] = e.messages
+            continue
+        query[str(lookup)] = value
+    return query, errors
+
+def compile_search(document, search_fields, text, text_index=False):
+    """
+    Returns `Q` object searching for ``text`` with ``$text`` operator if
+    ``text_index`` is true or in ``search_fields`` with case-sensitive
+    prefix regular expressions (which can use indexes) otherwise.
+    """
+    if text_index:
+        return Q(__raw__={'$text': {'$search': text}})
+    query = None
+    pattern = '^' + re.escape(text)
+    for name in search_fields:
+        db_field = document._fields[name].db_field
+        q = Q(__raw__={db_field: {'$regex': pattern}})
+        query = q if query is None else query | q
+    return query
+
+# (document, filter fields, search fields) -> ``True`` if text index exists
+_checked = {}
+
+def check_filter_indexes(document, filter_fields, search_fields=(),
+                         unindexed='error'):
+    """
+    Checks that each of ``filter_fields`` (and ``search_fields`` unless
+    the collection has a text index) is the first key of an index of the
+    ``document`` collection. Unindexed fields raise `ImproperlyConfigured`
+    if ``unindexed`` is ``'error'`` or are reported with
+    `UnindexedFilterWarning` if it is ``'warn'``.
+
+    Returns ``True`` if the collection has a text index. Indexes are read
+    only once per process.
+    """
+    key = (document, tuple(filter_fields), tuple(search_fields))
+    if key in _checked:
+        return _checked[key]
+
+    indexes = document._get_collection().index_information().values()
+    prefixes = set(index['key'][0][0] for index in indexes)
+    text_index = any(direction == 'text' for index in indexes
+                     for field, direction in index['key'])
+
+    names = [split_lookup(lookup)[0] for lookup in filter_fields]
+    if not text_index:
+        names.extend(search_fields)
+    missing = []
+    for name in names:
+        get_item_field(document, name)
+        db_field = document._fields[name].db_field
+        if db_field not in prefixes and db_field != '_id' and \
+                name not in missing:
+            missing.append(name)
+    if missing:
+        message = (u"Filters on %s fields %s are not supported by indexes"
+                   % (document.__name__, ', '.join(missing)))
+        if unindexed == 'error':
+            raise ImproperlyConfigured(message)
+        if unindexed == 'warn':
+            warnings.warn(message, UnindexedFilterWarning)
+
+    _checked[key] = text_index
+    return text_index
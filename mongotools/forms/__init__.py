@@ -1,6 +1,12 @@
 from functools import wraps
 
 import mongoengine
+from mongoengine import signals
+try:
+    from mongoengine.errors import SaveConditionError
+except ImportError:
+    # mongoengine < 0.10
+    SaveConditionError = None
 from mongoengine.fields import (ReferenceField, EmbeddedDocumentField,
                                 ListField, FileField)
 
@@ -11,9 +17,15 @@ from django.forms.forms import get_declared_fields
 from django.forms.util import ErrorList
 from django.forms.widgets import media_property
 from django.utils.datastructures import SortedDict
+from django.utils.text import capfirst, get_text_list
+from django.utils.translation import ugettext_lazy as _
 
+from mongotools.compat import write_concern_kwargs
 from mongotools.forms.fields import default_generator
-from mongotools.forms.utils import save_file, save_file_field
+from mongotools.forms.rendering import render_html_output
+from mongotools.forms.utils import FileBatch
+from mongotools.forms.widgets import GridFSMetadataBatch
+from mongotools.tenancy import get_reference_id, route_document
 
 __all__ = ('DocumentForm', 'EmbeddedDocumentForm')
 
@@ -51,12 +63,20 @@ def construct_instance(form, instance, fields=None, exclude=None):
     return instance
 
 def save_instance(form, instance, fields=None, exclude=None, commit=True,
-                  construct=True):
+                  construct=True, write_concern=None, write_behind=None,
+                  version_field=None):
     """
     Saves bound Form ``form``'s cleaned_data into document instance ``instance``.
 
     If commit=True, then the changes to ``instance`` will be saved to the
-    database. Returns ``instance``.
+    database with ``write_concern`` (a dict like ``{'w': 0}``) or, for new
+    documents, queued to ``write_behind`` `WriteBehindQueue`. Existing
+    documents with ``version_field`` are saved with `save_versioned`.
+    Returns ``instance``.
+
+    If commit=False, ``instance.save_files`` writes the files of the form
+    and ``instance.save_document`` saves the document only (checking
+    ``version_field``), see `save_with_files`.
 
     If construct=False, assume ``instance`` has already been constructed and
     just needs to be saved.
@@ -68,12 +88,17 @@ def save_instance(form, instance, fields=None, exclude=None, commit=True,
         raise ValueError("The `%s` could not be saved because the data didn't"
                          " validate." % (instance,))
 
-    def process_file_field_data(doc):
+    def process_file_field_data(batch, doc):
         if hasattr(doc, '_file_field_data'):
             for name, val in doc._file_field_data:
-                save_file_field(val, doc, name)
+                batch.add(val, doc, name)
 
     def save_files():
+        """
+        Writes new files concurrently and returns `FileBatch` which must be
+        committed after the document is saved.
+        """
+        batch = FileBatch()
         for field_name, f in instance._fields.items():
             if fields is not None and field_name not in fields:
                 continue
@@ -83,42 +108,81 @@ def save_instance(form, instance, fields=None, exclude=None, commit=True,
             # search for file data in `FileField`s
             if isinstance(f, FileField):
                 value = form.cleaned_data.get(field_name)
-                save_file_field(value, instance, field_name)
+                batch.add(value, instance, field_name)
 
             # search for file data in embedded docs
             # with ``_file_field_data`` prop created by forms (subforms)
             elif isinstance(f, EmbeddedDocumentField):
                 doc = instance[field_name]
-                process_file_field_data(doc)
+                process_file_field_data(batch, doc)
             elif (isinstance(f, ListField) and
                   isinstance(f.field, EmbeddedDocumentField)):
                 for doc in instance[field_name]:
-                    process_file_field_data(doc)
+                    process_file_field_data(batch, doc)
+        batch.write()
+        return batch
 
     if not hasattr(instance, 'save'):
         instance.save_files = save_files
         return instance
 
+    adding = getattr(instance, '_adding', True)
+    versioned = version_field is not None and not adding
+
+    def save_document(**kwargs):
+        """Saves ``instance`` (checking its version) without its files."""
+        if versioned:
+            return save_versioned(instance, version_field,
+                                  form.cleaned_data.get(version_field),
+                                  **kwargs)
+        return type(instance).save(instance, **kwargs)
+
     if commit:
-        save_files()
-        # do not validate as it's already done in
-        # `BaseDocumentForm._post_clean`
-        instance.save(validate=False)
+        if write_behind is not None and not versioned:
+            # files are committed (or rolled back) after the insert
+            batch = save_files()
+            try:
+                write_behind.put(instance, on_success=batch.commit,
+                                 on_failure=batch.rollback)
+            except:
+                batch.rollback()
+                raise
+        else:
+            # do not validate as it's already done in
+            # `BaseDocumentForm._post_clean`
+            save_with_files(save_files, save_document, validate=False,
+                            **write_concern_kwargs(write_concern))
     else:
         orig_save = instance.save
         def save_files_once_wrapper(f):
             @wraps(f)
             def wrapper(*args, **kwds):
-                save_files()
                 instance.save = orig_save
-                return f(*args, **kwds)
+                return save_with_files(save_files, f, *args, **kwds)
             return wrapper
 
         # save files right before next ``instance.save`` call
         instance.save = save_files_once_wrapper(orig_save)
+        # for callers saving the document themselves, see `save_with_files`
+        instance.save_files = save_files
+        instance.save_document = save_document
 
     return instance
 
+def save_with_files(save_files, save, *args, **kwargs):
+    """
+    Calls ``save`` between writing new files with ``save_files`` and
+    releasing replaced files. New files are released if ``save`` fails.
+    """
+    batch = save_files()
+    try:
+        result = save(*args, **kwargs)
+    except:
+        batch.rollback()
+        raise
+    batch.commit()
+    return result
+
 def document_to_dict(instance, fields=None, exclude=None):
     """
     Returns a dict containing the data in ``instance`` suitable for passing as
@@ -137,8 +201,11 @@ def document_to_dict(instance, fields=None, exclude=None):
             continue
         if exclude and field_name in exclude:
             continue
-        if isinstance(f, ReferenceField) and instance[field_name]:
-            data[field_name] = unicode(instance[field_name].id)
+        if isinstance(f, ReferenceField):
+            # not dereferenced, referenced documents may be stored in
+            # a tenant database
+            pk = get_reference_id(instance, field_name)
+            data[field_name] = unicode(pk) if pk is not None else None
         else:
             data[field_name] = instance[field_name]
     return data
@@ -206,6 +273,43 @@ def fields_for_document(document, fields=None, exclude=None, widgets=None, formf
         )
     return field_dict
 
+def get_unique_checks(document, exclude=None):
+    """
+    Returns a list of field name tuples which must be unique together for
+    the given ``document`` class.
+
+    Both ``unique``/``unique_with`` field options and unique indexes declared
+    in ``meta['indexes']`` are taken into account. Checks which contain
+    excluded fields or fields not stored at the document top level are
+    skipped (they are still enforced by the database on save).
+    """
+    meta = getattr(document, '_meta', None) or {}
+    specs = list(meta.get('unique_indexes') or [])
+    for spec in meta.get('index_specs') or []:
+        if isinstance(spec, dict) and spec.get('unique'):
+            specs.append(spec['fields'])
+
+    db_field_map = dict((f.db_field, name)
+                        for name, f in document._fields.items())
+    checks = []
+    for spec in specs:
+        check = []
+        for key in spec:
+            if isinstance(key, (list, tuple)):
+                key = key[0]
+            name = db_field_map.get(key.lstrip('-+$#'))
+            if name is None:
+                # embedded (dotted) or unknown key
+                check = None
+                break
+            check.append(name)
+        if not check or tuple(check) in checks:
+            continue
+        if exclude and set(check) & set(exclude):
+            continue
+        checks.append(tuple(check))
+    return checks
+
 
 
 class DocumentFormOptions(object):
@@ -215,6 +319,9 @@ class DocumentFormOptions(object):
         self.exclude = getattr(options, 'exclude', None)
         self.widgets = getattr(options, 'widgets', None)
         self.embedded_field = getattr(options, 'embedded_field', None)
+        self.atomic = getattr(options, 'atomic', False)
+        self.write_concern = getattr(options, 'write_concern', None)
+        self.version_field = getattr(options, 'version_field', None)
         self.formfield_generator = getattr(options, 'formfield_generator', None)
 
 
@@ -223,12 +330,9 @@ class DocumentFormMetaClass(type):
     # see django.forms.forms.ModelFormMetaclass
 
     def __new__(cls, name, bases, attrs):
-        try:
-            parents = [b for b in bases if issubclass(b, DocumentForm) or
-                                           issubclass(b, EmbeddedDocumentForm)]
-        except NameError:
-            # We are defining DocumentForm itself.
-            parents = None
+        # only subclasses of `DocumentForm`, `EmbeddedDocumentForm`
+        # (and other classes using this metaclass) are processed
+        parents = [b for b in bases if isinstance(b, DocumentFormMetaClass)]
         new_class = super(DocumentFormMetaClass, cls).__new__(cls, name, bases,
                 attrs)
         if not parents:
@@ -254,6 +358,16 @@ class DocumentFormMetaClass(type):
             # Override default document fields with any custom declared ones
             # (plus, include all the other declared fields).
             fields.update(declared_fields)
+            if (opts.version_field and
+                    opts.version_field not in opts.document._fields):
+                raise FieldError('Unknown version field %s specified for %s'
+                                 % (opts.version_field,
+                                    opts.document.__name__))
+            if (opts.version_field and
+                    opts.version_field not in declared_fields):
+                # submitted back with the form, see `save_versioned`
+                fields[opts.version_field] = forms.IntegerField(
+                    required=False, widget=forms.HiddenInput)
             # filter fields not supported by ``formfield_generator`` and not
             # replaced by ``declared_fields``
             for n, f in fields.items():
@@ -268,6 +382,14 @@ class DocumentFormMetaClass(type):
 
 class BaseDocumentForm(forms.BaseForm):
 
+    unique_error_message = _(u"%(document_name)s with this %(field_labels)s"
+                             u" already exists.")
+    version_conflict_message = _(u"This %(document_name)s has been changed"
+                                 u" by someone else. Please reload it and"
+                                 u" try again.")
+    # render `as_table`, `as_p` and `as_ul` with cached labels and help texts
+    compiled_rendering = True
+
     def __init__(self, data=None, files=None, auto_id='id_%s', prefix=None,
                  initial=None, error_class=ErrorList, label_suffix=':',
                  empty_permitted=False, instance=None):
@@ -277,18 +399,34 @@ class BaseDocumentForm(forms.BaseForm):
                 raise ValueError('DocumentForm has no document class specified.')
             # if we didn't get an instance, instantiate a new one
             self.instance = opts.document()
+            if hasattr(self.instance, '_get_collection'):
+                route_document(self.instance)
             object_data = {}
             self.instance._adding = True
         else:
             self.instance = instance
             self.instance._adding = False
             object_data = document_to_dict(instance, opts.fields, opts.exclude)
+            if opts.version_field:
+                object_data[opts.version_field] = instance[opts.version_field]
         # if initial was provided, it should override the values from instance
         if initial is not None:
             object_data.update(initial)
 
         super(BaseDocumentForm, self).__init__(data, files, auto_id, prefix, object_data,
                                         error_class, label_suffix, empty_permitted)
+        self._validate_unique = False
+        # resolve metadata of all initial files with one query on render
+        GridFSMetadataBatch(self.initial.values())
+
+    def _html_output(self, normal_row, error_row, row_ender, help_text_html,
+                     errors_on_separate_row):
+        if not self.compiled_rendering:
+            return super(BaseDocumentForm, self)._html_output(
+                normal_row, error_row, row_ender, help_text_html,
+                errors_on_separate_row)
+        return render_html_output(self, normal_row, error_row, row_ender,
+                                  help_text_html, errors_on_separate_row)
 
     def _update_errors(self, message_dict):
         # see `django.forms.models.BaseModelForm._update_errors`
@@ -343,6 +481,10 @@ class BaseDocumentForm(forms.BaseForm):
                     exclude.append(field_name)
         return exclude
 
+    def clean(self):
+        self._validate_unique = True
+        return self.cleaned_data
+
     def _post_clean(self):
         opts = self._meta
         # Update the document instance with self.cleaned_data.
@@ -374,16 +516,112 @@ class BaseDocumentForm(forms.BaseForm):
             except mongoengine.ValidationError, e:
                 self._update_errors({NON_FIELD_ERRORS: [e.message]})
 
-    def save(self, commit=True):
-        """save the instance or create a new one.."""
+        # Validate uniqueness if needed.
+        if self._validate_unique:
+            self.validate_unique()
+
+    def validate_unique(self):
+        """
+        Checks unique constraints of the document against the database.
+        All constraints are tested with a single ``$or`` query which only
+        fetches the constrained fields of at most one conflicting document
+        per constraint. See `django.forms.models.BaseModelForm.validate_unique`.
+        """
+        instance = self.instance
+        if not hasattr(instance, '_get_collection'):
+            # embedded documents are not stored in own collection
+            return
+        checks = get_unique_checks(instance.__class__,
+                                   self._get_validation_exclusions())
+
+        queries = []
+        used_checks = []
+        for check in checks:
+            query = {}
+            for name in check:
+                value = instance[name]
+                if value is None:
+                    # see `django.db.models.Model._perform_unique_checks`
+                    query = None
+                    break
+                f = instance._fields[name]
+                query[f.db_field] = f.to_mongo(value)
+            if query:
+                queries.append(query)
+                used_checks.append((check, query))
+        if not queries:
+            return
+
+        spec = {'$or': queries}
+        if not getattr(instance, '_adding', True) and instance.pk is not None:
+            spec['_id'] = {'$ne': instance._fields[
+                instance._meta['id_field']].to_mongo(instance.pk)}
+        projection = dict.fromkeys(set(k for q in queries for k in q), 1)
+        projection['_id'] = 1
+
+        collection = instance._get_collection()
+        cursor = collection.find(spec, projection).limit(len(queries))
+
+        errors = {}
+        for raw in cursor:
+            for check, query in used_checks:
+                if any(raw.get(k) != v for k, v in query.items()):
+                    continue
+                if len(check) == 1:
+                    key = check[0]
+                else:
+                    key = NON_FIELD_ERRORS
+                message = self.get_unique_error_message(check)
+                if message not in errors.setdefault(key, []):
+                    errors[key].append(message)
+        if errors:
+            self._update_errors(errors)
+
+    def get_unique_error_message(self, check):
+        labels = []
+        for name in check:
+            if name in self.fields and self.fields[name].label:
+                labels.append(unicode(self.fields[name].label))
+            else:
+                labels.append(capfirst(name))
+        return self.unique_error_message % {
+            'document_name': self.instance.__class__.__name__,
+            'field_labels': unicode(get_text_list(labels, _('and'))),
+        }
+
+    def save(self, commit=True, write_concern=None, write_behind=None):
+        """
+        save the instance or create a new one..
+
+        ``write_concern`` defaults to ``Meta.write_concern``. With
+        unacknowledged writes (``{'w': 0}``) or ``write_behind`` queue,
+        unique errors are not reported.
+
+        If ``Meta.version_field`` is set, existing documents are saved only
+        if they were not changed since the form was rendered, see
+        `save_versioned`.
+        """
         opts = self._meta
         if not commit:
-            return save_instance(self, self.instance, opts.fields, opts.exclude, commit)
+            return save_instance(self, self.instance, opts.fields, opts.exclude,
+                                 commit, version_field=opts.version_field)
+        if write_concern is None:
+            write_concern = opts.write_concern
+        if write_behind is not None and not self.instance._adding:
+            raise ValueError("Only new documents can be queued for insert.")
         try:
-            doc = save_instance(self, self.instance, opts.fields, opts.exclude, commit)
+            doc = save_instance(self, self.instance, opts.fields, opts.exclude,
+                                commit, write_concern=write_concern,
+                                write_behind=write_behind,
+                                version_field=opts.version_field)
         except mongoengine.NotUniqueError, e:
             self._update_errors({NON_FIELD_ERRORS: [e.message]})
             return None
+        except VersionConflict:
+            self._update_errors({NON_FIELD_ERRORS: [
+                self.version_conflict_message % {
+                    'document_name': self.instance.__class__.__name__}]})
+            return None
         return doc
 
 
@@ -399,6 +637,9 @@ class EmbeddedDocumentForm(BaseDocumentForm):
                  empty_permitted=False, instance=None, parent_document=None):
         super(EmbeddedDocumentForm, self).__init__(data, files, auto_id,
            prefix, initial, error_class, label_suffix, empty_permitted, instance)
+        # stored value of an edited list item, atomic saves match it
+        self._stored_value = (instance.to_mongo() if instance is not None
+                              else None)
         if (not parent_document and hasattr(self.instance, '_instance') and
             self.instance._instance is not None):
             parent_document = self.instance._instance
@@ -423,10 +664,22 @@ class EmbeddedDocumentForm(BaseDocumentForm):
 
     parent_document = property(_get_parent_document, _set_parent_document)
 
-    def save(self, commit=True):
+    def save(self, commit=True, atomic=None):
+        """
+        Saves the embedded document into the parent document.
+
+        If ``atomic`` is true (defaults to ``Meta.atomic``), only the embedded
+        value is written with a targeted ``$set`` or ``$push`` update of the
+        top-level document instead of saving the whole top-level document.
+        Edited list items are matched by their stored value (`VersionConflict`
+        is raised if it was changed or removed meanwhile). Documents embedded
+        in items of another list are saved whole.
+        """
         opts = self._meta
         doc_cls = opts.document.__name__
         instance = self.instance
+        if atomic is None:
+            atomic = opts.atomic
 
         if self.errors:
             raise ValueError("The %s could not be saved because the data didn't"
@@ -446,12 +699,23 @@ class EmbeddedDocumentForm(BaseDocumentForm):
                       construct=False)
 
         parent_field = self._parent_document._fields[field_name]
+        spec = None
         if isinstance(parent_field, EmbeddedDocumentField):
             val = instance
             setattr(self.parent_document, opts.embedded_field, val)
+            operator, path = '$set', [parent_field.db_field]
         elif isinstance(parent_field, ListField):
             l = getattr(self.parent_document, opts.embedded_field)
-            l.append(instance)
+            for item in l:
+                if item is instance:
+                    # editing of existing list item, matched by its stored
+                    # value as indexes may be shifted by concurrent updates
+                    operator, path = '$set', [parent_field.db_field, '$']
+                    spec = self._stored_value
+                    break
+            else:
+                l.append(instance)
+                operator, path = '$push', [parent_field.db_field]
         else:
             raise NotImplementedError("The %s could not be saved because the parent"
                          " document field type %s is not supported."
@@ -465,14 +729,131 @@ class EmbeddedDocumentForm(BaseDocumentForm):
                    doc._instance is not None):
                 doc = doc._instance
 
+            save = doc.save
+            if atomic and doc.pk is not None:
+                parent_path = get_embedded_path(self.parent_document)[1]
+                # the positional operator can address only one list and
+                # list items without stored fields can't be matched
+                if '$' not in parent_path and (spec or '$' not in path):
+                    key = '.'.join(parent_path + path)
+                    if spec:
+                        spec = {'.'.join(parent_path + path[:1]):
+                                    {'$elemMatch': spec}}
+                    def save():
+                        if not update_document(doc, {operator: {
+                                key: instance.to_mongo()}}, spec):
+                            raise VersionConflict()
             if hasattr(instance, 'save_files'):
-                instance.save_files()
-            doc.save()
+                save_with_files(instance.save_files, save)
+            else:
+                save()
 
         return instance
 
 
 
+def _unwrap(doc):
+    # ``_instance`` may be a weak reference proxy, bound methods are bound
+    # to the referenced document
+    return getattr(doc.to_mongo, '__self__', doc)
+
+def _locate_embedded(parent, doc):
+    doc = _unwrap(doc)
+    for name, f in parent._fields.items():
+        value = parent._data.get(name)
+        if value is None:
+            continue
+        if isinstance(f, ListField) and isinstance(value, list):
+            if any(item is doc for item in value):
+                return [f.db_field, '$']
+        elif value is doc:
+            return [f.db_field]
+    raise ValueError("The %s could not be found in its parent document."
+                     % doc.__class__.__name__)
+
+def get_embedded_path(doc):
+    """
+    Returns a ``(document, path)`` tuple, where ``document`` is the
+    top-level `Document` reached via ``_instance`` chain of ``doc`` and
+    ``path`` is a list of db field names (``'$'`` for list items) leading
+    from ``document`` to ``doc``.
+    """
+    path = []
+    while not hasattr(doc, 'save'):
+        parent = getattr(doc, '_instance', None)
+        if parent is None:
+            raise ValueError("The %s is not attached to a top-level document."
+                             % doc.__class__.__name__)
+        path[:0] = _locate_embedded(parent, doc)
+        doc = parent
+    return doc, path
+
+def update_document(document, update, spec=None):
+    """
+    Applies raw ``update`` to the stored ``document`` (if it also matches
+    ``spec``) with a single ``update`` command. Returns ``True`` if the
+    document matched.
+    """
+    collection = document._get_collection()
+    spec = dict(spec or {})
+    spec['_id'] = document._fields[document._meta['id_field']].to_mongo(
+        document.pk)
+    if hasattr(collection, 'update_one'):
+        # pymongo 3+
+        return collection.update_one(spec, update).matched_count > 0
+    result = collection.update(spec, update, multi=False)
+    return result is None or result.get('n', 0) > 0
+
+def save_versioned(document, version_field, version, **kwargs):
+    """
+    Saves ``document`` (with ``kwargs``) only if its stored
+    ``version_field`` is equal to ``version`` and increments the version.
+    Raises `VersionConflict` if the document was changed in the meantime
+    and `ValueError` for unacknowledged writes, whose result is unknown.
+
+    With mongoengine 0.10+ the document is saved with `Document.save` and
+    ``save_condition``. Older versions save changed fields with a raw
+    conditional update, so overridden ``save`` methods are not called
+    (``pre_save`` and ``post_save`` signals are sent though).
+    """
+    if not (kwargs.get('write_concern') or {}).get('w', 1) or \
+            kwargs.get('safe') is False:
+        raise ValueError("Versioned documents can not be saved with"
+                         " unacknowledged writes.")
+    document[version_field] = (version or 0) + 1
+    if SaveConditionError is not None:
+        try:
+            document.save(save_condition={version_field: version}, **kwargs)
+        except SaveConditionError:
+            document[version_field] = version
+            raise VersionConflict()
+        return document
+
+    db_field = document._fields[version_field].db_field
+    signals.pre_save.send(document.__class__, document=document)
+    sets, unsets = document._delta()
+    sets.pop(db_field, None)
+    unsets.pop(db_field, None)
+    update = {'$inc': {db_field: 1}}
+    if sets:
+        update['$set'] = sets
+    if unsets:
+        update['$unset'] = unsets
+    if not update_document(document, update, {db_field: version}):
+        document[version_field] = version
+        raise VersionConflict()
+    if hasattr(document, '_clear_changed_fields'):
+        document._clear_changed_fields()
+    signals.post_save.send(document.__class__, document=document,
+                           created=False)
+    return document
+
+
+class VersionConflict(Exception):
+    """The document was changed since its version was read."""
+
+
+
 def documentform_factory(document, form=DocumentForm, fields=None, exclude=None,
                   widgets=None, formfield_generator=None, embedded_field=None):
     # see: `django.forms.models.modelform_factory`
@@ -505,6 +886,12 @@ def documentform_factory(document, form=DocumentForm, fields=None, exclude=None,
     # Class attributes for the new form class.
     form_class_attrs = {
         'Meta': Meta,
+        # used to rebuild the class in other processes,
+        # see `mongotools.forms.engine.ParallelDocumentFormValidator`
+        '_factory_args': (document, form, dict(
+            fields=fields, exclude=exclude, widgets=widgets,
+            formfield_generator=formfield_generator,
+            embedded_field=embedded_field)),
     }
 
     form_metaclass = DocumentFormMetaClass
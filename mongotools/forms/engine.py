@@ -0,0 +1,201 @@
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+
+
+def chunked(iterable, size):
+    """Yields lists of at most ``size`` items of ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class DocumentFormValidator(object):
+    """
+    Validates many data dicts against a single ``form_class`` instance.
+
+    `BaseDocumentForm` performs a deep copy of all its fields and builds
+    ``initial`` on every instantiation. This validator instantiates the form
+    once and rebinds it to every new data dict, so the usual form
+    validation (fields cleaning, ``clean`` and ``_post_clean``) is reused
+    without the per-form construction overhead.
+    """
+
+    def __init__(self, form_class, **form_kwargs):
+        self.form_class = form_class
+        form_kwargs.setdefault('data', {})
+        self.form = form_class(**form_kwargs)
+
+    def bind(self, data, files=None, instance=None):
+        """
+        Rebinds the form to ``data`` (and ``files``) and returns it.
+        New document instance is created if ``instance`` is not given.
+        """
+        form = self.form
+        form.data = data
+        form.files = files or {}
+        form.is_bound = True
+        form._errors = None
+        form._changed_data = None
+        form._validate_unique = False
+        if hasattr(form, 'cleaned_data'):
+            del form.cleaned_data
+        if instance is None:
+            instance = form._meta.document()
+            instance._adding = True
+        else:
+            instance._adding = False
+        form.instance = instance
+        return form
+
+    def validate(self, data, files=None, instance=None):
+        """
+        Validates ``data`` and returns a ``(instance, errors)`` tuple.
+        ``instance`` is a constructed (but not saved) document if data
+        is valid, ``errors`` is a dict of error lists otherwise.
+        """
+        form = self.bind(data, files, instance)
+        if form.is_valid():
+            return form.instance, None
+        return None, dict((k, [unicode(e) for e in v])
+                          for k, v in form.errors.items())
+
+    def iter_validate(self, rows):
+        """
+        Yields ``(instance, errors)`` tuples for every data dict of ``rows``.
+        """
+        for data in rows:
+            yield self.validate(data)
+
+
+
+
+def get_form_class_spec(form_class):
+    """
+    Returns picklable specification of ``form_class``. Classes created with
+    `documentform_factory` can not be pickled by reference, so factory
+    arguments are returned for them instead.
+    """
+    if '_factory_args' in form_class.__dict__:
+        return form_class._factory_args
+    return form_class
+
+def build_form_class(spec):
+    """Returns form class for specification built by `get_form_class_spec`."""
+    if isinstance(spec, tuple):
+        from mongotools.forms import documentform_factory
+        document, form, kwargs = spec
+        return documentform_factory(document, form, **kwargs)
+    return spec
+
+# per worker process validator, see `ParallelDocumentFormValidator`
+_worker_validator = None
+
+def _reset_connections():
+    """
+    Drops connections (and cached databases and collections) inherited from
+    the parent process, they are reopened on use.
+    """
+    from mongoengine import connection
+    from mongotools.orphans import _iter_documents
+    connection._connections.clear()
+    getattr(connection, '_dbs', {}).clear()
+    for document in _iter_documents():
+        document._collection = None
+
+def _init_worker(form_class_spec, form_kwargs):
+    global _worker_validator
+    # sockets of forked clients are shared with the parent process
+    _reset_connections()
+    form_class = build_form_class(form_class_spec)
+    _worker_validator = DocumentFormValidator(form_class, **form_kwargs)
+
+def _validate_chunk(chunk):
+    results = []
+    for data in chunk:
+        instance, errors = _worker_validator.validate(data)
+        if instance is not None:
+            instance = instance.to_mongo()
+        results.append((instance, errors))
+    return results
+
+
+class ParallelDocumentFormValidator(object):
+    """
+    Validates data dicts with ``form_class`` in a pool of worker processes.
+
+    Data dicts are sent to workers in pickled chunks of ``chunk_size``. Every
+    worker builds its own form class (from `documentform_factory` arguments
+    for factory made classes) and `DocumentFormValidator` and opens its own
+    database connections. Up to ``max_pending`` chunks (twice the number of
+    processes by default) are kept submitted, a new chunk is submitted as
+    soon as the oldest one is done, so input is not read ahead unboundedly.
+
+    Data dicts must be picklable; results are ``(son, errors)`` tuples in
+    input order, where ``son`` is the validated document converted with
+    ``to_mongo``. The pool is created lazily and must be released with
+    `close` (or by using the validator as a context manager).
+    """
+
+    def __init__(self, form_class, processes=None, chunk_size=100,
+                 max_pending=None, **form_kwargs):
+        self.form_class = form_class
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.form_kwargs = form_kwargs
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = Pool(self.processes, _init_worker,
+                              (get_form_class_spec(self.form_class),
+                               self.form_kwargs))
+        return self._pool
+
+    pool = property(_get_pool)
+
+    def iter_validate(self, rows):
+        """
+        Yields ``(son, errors)`` tuples for every data dict of ``rows``.
+        """
+        pool = self.pool
+        max_pending = self.max_pending or (self.processes or cpu_count()) * 2
+        pending = deque()
+        for chunk in chunked(rows, self.chunk_size):
+            pending.append(pool.apply_async(_validate_chunk, (chunk,)))
+            if len(pending) >= max_pending:
+                for result in pending.popleft().get():
+                    yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+
+    def validate_many(self, rows):
+        """Returns a list of ``(son, errors)`` tuples, see `iter_validate`."""
+        return list(self.iter_validate(rows))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
@@ -1,6 +1,7 @@
 from bson import ObjectId
 from pymongo.errors import InvalidId
 
+from mongoengine.connection import DEFAULT_CONNECTION_NAME
 from mongoengine.fields import (ReferenceField as MongoReferenceField,
                                 IntField, SequenceField)
 
@@ -11,6 +12,8 @@ from django.utils.text import capfirst
 from django.utils.translation import ugettext_lazy as _
 
 from mongotools.forms.widgets import ClearableGridFSFileInput
+from mongotools.indexadvisor import collect_queryset, get_source_name
+from mongotools.tenancy import route_alias, route_queryset
 
 
 
@@ -21,11 +24,17 @@ class MongoChoiceIterator(object):
 
     def __init__(self, field):
         self.field = field
-        self.queryset = field.queryset
+
+    @property
+    def queryset(self):
+        # routed to the current tenant on every access
+        return self.field.queryset
 
     def __iter__(self):
         if self.field.empty_label is not None:
             yield (u"", self.field.empty_label)
+        if not self.field.cache_choices or self.field.choice_cache is None:
+            collect_queryset(get_source_name(self.field), self.queryset)
         if self.field.cache_choices:
             if self.field.choice_cache is None:
                 self.field.choice_cache = [
@@ -43,6 +52,20 @@ class MongoChoiceIterator(object):
     def choice(self, obj):
         return (self.field.prepare_value(obj), self.field.label_from_instance(obj))
 
+    def get_cache_key(self):
+        """
+        Returns a key identifying the choice set, see
+        `mongotools.forms.widgets.CachedChoicesMixin`.
+        """
+        queryset = self.queryset
+        field_cls = self.field.__class__
+        document = queryset._document
+        alias = route_alias(document._meta.get('db_alias') or
+                            DEFAULT_CONNECTION_NAME)
+        return '%s:%s:%s' % (alias, document._get_collection_name(), hash((
+            repr(queryset._query), repr(getattr(queryset, '_ordering', None)),
+            self.field.empty_label, field_cls.__module__, field_cls.__name__)))
+
 
 class MongoCharField(forms.CharField):
     def to_python(self, value):
@@ -74,11 +97,11 @@ class ReferenceField(forms.ChoiceField):
 
     def __deepcopy__(self, memo):
         result = super(forms.ChoiceField, self).__deepcopy__(memo)
-        result.queryset = result.queryset.clone()
+        result.queryset = self._queryset.clone()
         return result
 
     def _get_queryset(self):
-        return self._queryset
+        return route_queryset(self._queryset)
 
     def _set_queryset(self, queryset):
         self._queryset = queryset
@@ -104,6 +127,11 @@ class ReferenceField(forms.ChoiceField):
             return value.pk
         return super(ReferenceField, self).prepare_value(value)
 
+    def validate(self, value):
+        # Do not iterate over all choices like `forms.ChoiceField.validate`,
+        # valid choice is looked up in queryset by `clean`.
+        return forms.Field.validate(self, value)
+
     def clean(self, value):
         if value in EMPTY_VALUES:
             if self.required:
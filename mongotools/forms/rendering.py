@@ -0,0 +1,192 @@
+"""
+Compiled rendering of `BaseDocumentForm.as_table`, `as_p` and `as_ul`.
+
+Rows of wide forms are mostly static: labels (with ``for`` attributes),
+help texts and attributes of text inputs and textareas depend only on the
+form class and its ``auto_id``, ``prefix`` and ``label_suffix``. They are
+rendered once per layout and kept in a module level cache, while values,
+other widgets (e.g. selects with dynamic choices), errors and CSS classes
+are rendered on every call. Fields changed per instance (e.g. labels set in
+``__init__``) and translated labels in other languages get their own
+layout.
+"""
+from django.forms.forms import BoundField
+from django.forms.widgets import Input, Textarea
+from django.utils.encoding import force_unicode
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+__all__ = ('render_html_output',)
+
+# marks values filled in on every render in compiled rows and widgets
+PLACEHOLDER = u'\x00'
+VALUE_PLACEHOLDER = u'\x01'
+MAX_COMPILED_LAYOUTS = 200
+
+# layout key -> [(name, row parts or ``None`` for hidden fields, compiled
+# widget or ``None``), ...]
+_layouts = {}
+
+
+
+class _Placeholders(dict):
+    def __missing__(self, key):
+        return PLACEHOLDER + key + PLACEHOLDER
+
+def _text(value):
+    # lazy translations are hashed by identity, so they are resolved for
+    # the active language
+    return value if value is None else force_unicode(value)
+
+def get_layout_key(form, normal_row, help_text_html):
+    fields = tuple((name, _text(field.label), _text(field.help_text),
+                    field.widget.__class__, field.widget.is_localized,
+                    field.show_hidden_initial,
+                    tuple(sorted(field.widget.attrs.items())))
+                   for name, field in form.fields.items())
+    return (form.__class__, normal_row, help_text_html, form.auto_id,
+            form.prefix, _text(form.label_suffix), fields)
+
+def _render_func(widget_class):
+    return getattr(widget_class.render, 'im_func', None)
+
+_input_render = _render_func(Input)
+_textarea_render = _render_func(Textarea)
+
+def compile_widget(bf):
+    """
+    Returns ``(empty, prefix, suffix)`` tuple of `Input` or `Textarea`
+    widget of bound field ``bf`` rendered around its value (``empty`` is
+    the input rendered without value) or ``None`` if the widget must be
+    rendered every time.
+    """
+    widget = bf.field.widget
+    render = _render_func(widget.__class__)
+    if bf.field.show_hidden_initial or render is None or \
+            render not in (_input_render, _textarea_render):
+        return None
+    # see `django.forms.forms.BoundField.as_widget`
+    attrs = {}
+    if bf.auto_id and 'id' not in widget.attrs:
+        attrs['id'] = bf.auto_id
+    parts = widget.render(bf.html_name, VALUE_PLACEHOLDER,
+                          dict(attrs)).split(VALUE_PLACEHOLDER)
+    if len(parts) != 2:
+        return None
+    empty = None
+    if render is _input_render:
+        empty = widget.render(bf.html_name, None, dict(attrs))
+    return empty, parts[0], parts[1]
+
+def render_widget(bf, compiled):
+    """Renders widget of bound field ``bf`` compiled by `compile_widget`."""
+    if compiled is None:
+        return unicode(bf)
+    empty, prefix, suffix = compiled
+    value = bf.value()
+    if value is None:
+        value = ''
+    if empty is not None:
+        # see `django.forms.widgets.Input.render`
+        if value == '':
+            return empty
+        value = bf.field.widget._format_value(value)
+    return prefix + conditional_escape(force_unicode(value)) + suffix
+
+def compile_layout(form, normal_row, help_text_html):
+    """
+    Returns rows of ``form`` with labels and help texts rendered into
+    ``normal_row``, split into static parts (even items) and names of
+    per-render values (odd items), with compiled widgets.
+    """
+    layout = []
+    for name, field in form.fields.items():
+        bf = BoundField(form, field, name)
+        widget = compile_widget(bf)
+        if bf.is_hidden:
+            layout.append((name, None, widget))
+            continue
+        # see `django.forms.forms.BaseForm._html_output`
+        if bf.label:
+            label = conditional_escape(force_unicode(bf.label))
+            if form.label_suffix and label[-1] not in ':?.!':
+                label += form.label_suffix
+            label = bf.label_tag(label) or ''
+        else:
+            label = ''
+        if field.help_text:
+            help_text = help_text_html % force_unicode(field.help_text)
+        else:
+            help_text = u''
+        row = normal_row % _Placeholders(label=force_unicode(label),
+                                         help_text=help_text)
+        layout.append((name, row.split(PLACEHOLDER), widget))
+    return layout
+
+def get_layout(form, normal_row, help_text_html):
+    key = get_layout_key(form, normal_row, help_text_html)
+    layout = _layouts.get(key)
+    if layout is None:
+        layout = compile_layout(form, normal_row, help_text_html)
+        if len(_layouts) >= MAX_COMPILED_LAYOUTS:
+            _layouts.clear()
+        _layouts[key] = layout
+    return layout
+
+def render_html_output(form, normal_row, error_row, row_ender,
+                       help_text_html, errors_on_separate_row):
+    """
+    Same as `BaseForm._html_output`, but static parts of rows (labels and
+    help texts) are rendered once per form class layout, only widgets,
+    errors and CSS classes are rendered every time.
+    """
+    top_errors = form.non_field_errors()
+    output, hidden_fields = [], []
+    html_class_attr = ''
+    for name, parts, widget in get_layout(form, normal_row, help_text_html):
+        bf = BoundField(form, form.fields[name], name)
+        bf_errors = form.error_class([conditional_escape(error)
+                                      for error in bf.errors])
+        if parts is None:
+            if bf_errors:
+                top_errors.extend([u'(Hidden field %s) %s' % (
+                    name, force_unicode(e)) for e in bf_errors])
+            hidden_fields.append(render_widget(bf, widget))
+            continue
+
+        css_classes = bf.css_classes()
+        html_class_attr = ' class="%s"' % css_classes if css_classes else ''
+        if errors_on_separate_row and bf_errors:
+            output.append(error_row % force_unicode(bf_errors))
+        values = {
+            'errors': force_unicode(bf_errors),
+            'field': render_widget(bf, widget),
+            'html_class_attr': html_class_attr,
+            'css_classes': css_classes,
+            'field_name': bf.html_name,
+        }
+        row = list(parts)
+        for i in range(1, len(row), 2):
+            row[i] = values.get(row[i], u'')
+        output.append(u''.join(row))
+
+    if top_errors:
+        output.insert(0, error_row % force_unicode(top_errors))
+    if hidden_fields:
+        str_hidden = u''.join(hidden_fields)
+        if output:
+            last_row = output[-1]
+            # chop off the trailing row_ender (e.g. '</td></tr>') and
+            # insert the hidden fields
+            if not last_row.endswith(row_ender):
+                # there may be no visible fields or the last row may be
+                # an error row
+                last_row = normal_row % {
+                    'errors': '', 'label': '', 'field': '', 'help_text': '',
+                    'html_class_attr': html_class_attr, 'css_classes': '',
+                    'field_name': ''}
+                output.append(last_row)
+            output[-1] = last_row[:-len(row_ender)] + str_hidden + row_ender
+        else:
+            output.append(str_hidden)
+    return mark_safe(u'\n'.join(output))
@@ -0,0 +1,121 @@
+from bson import ObjectId, DBRef
+
+from django import forms
+from django.core.serializers.json import DjangoJSONEncoder
+from django.forms.util import ErrorList
+
+from mongotools.forms import (BaseDocumentForm, DocumentFormMetaClass,
+                              document_to_dict, documentform_factory)
+from mongotools.tenancy import route_document
+
+__all__ = ('DocumentSerializer', 'documentserializer_factory',
+           'MongoJSONEncoder')
+
+
+
+class MongoJSONEncoder(DjangoJSONEncoder):
+    """
+    JSON encoder which supports `ObjectId`, `DBRef` and documents
+    (encoded as their primary key) in addition to `DjangoJSONEncoder` types.
+    """
+
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return unicode(o)
+        if isinstance(o, DBRef):
+            return unicode(o.id)
+        if hasattr(o, '_meta') and hasattr(o, 'pk'):
+            return self.default(o.pk) if isinstance(o.pk, ObjectId) else o.pk
+        if hasattr(o, 'to_mongo'):
+            # embedded document
+            return o.to_mongo()
+        if hasattr(o, 'grid_id'):
+            # `GridFSProxy`
+            return unicode(o.grid_id) if o.grid_id else None
+        return super(MongoJSONEncoder, self).default(o)
+
+
+class BaseDocumentSerializer(BaseDocumentForm):
+    """
+    Data-only document form for JSON APIs.
+
+    Uses the same form fields and document validation as `DocumentForm`,
+    but does not copy form fields (and their widgets or choice iterators)
+    per instance, does not build ``initial`` from the document and takes
+    values directly from ``data`` (a dict decoded from JSON), so native
+    JSON types (numbers, booleans, lists of ids) are accepted as is.
+
+    If ``partial`` is true, fields missing in ``data`` are left untouched.
+    File fields are not supported and ignored.
+    """
+
+    def __init__(self, data=None, instance=None, partial=False, prefix=None,
+                 error_class=ErrorList):
+        opts = self._meta
+        if instance is None:
+            if opts.document is None:
+                raise ValueError('DocumentSerializer has no document class'
+                                 ' specified.')
+            self.instance = route_document(opts.document())
+            self.instance._adding = True
+        else:
+            self.instance = instance
+            self.instance._adding = False
+
+        # see `django.forms.forms.BaseForm.__init__`
+        self.is_bound = data is not None
+        self.data = data or {}
+        self.files = {}
+        self.auto_id = ''
+        self.prefix = prefix
+        self.initial = {}
+        self.error_class = error_class
+        self.label_suffix = ''
+        self.empty_permitted = False
+        self._errors = None
+        self._changed_data = None
+        self._validate_unique = False
+        self.partial = partial
+        # form fields are not modified while cleaning, so they are shared
+        self.fields = self.base_fields
+
+    def _clean_fields(self):
+        for name, field in self.fields.items():
+            if isinstance(field, forms.FileField):
+                continue
+            key = self.add_prefix(name)
+            if self.partial and key not in self.data:
+                continue
+            value = self.data.get(key)
+            try:
+                self.cleaned_data[name] = field.clean(value)
+                if hasattr(self, 'clean_%s' % name):
+                    self.cleaned_data[name] = getattr(self, 'clean_%s' % name)()
+            except forms.ValidationError, e:
+                self._errors[name] = self.error_class(e.messages)
+                if name in self.cleaned_data:
+                    del self.cleaned_data[name]
+
+    def get_error_dict(self):
+        """Returns errors as a dict of lists of unicode strings."""
+        return dict((k, [unicode(e) for e in v])
+                    for k, v in self.errors.items())
+
+    def to_data(self):
+        """
+        Returns a dict of the instance data for fields of this serializer.
+        """
+        opts = self._meta
+        data = document_to_dict(self.instance, opts.fields, opts.exclude)
+        data['id'] = self.instance.pk
+        return data
+
+
+class DocumentSerializer(BaseDocumentSerializer):
+    __metaclass__ = DocumentFormMetaClass
+
+
+def documentserializer_factory(document, serializer=DocumentSerializer,
+                               **kwargs):
+    """See `documentform_factory`."""
+    return documentform_factory(document, form=serializer, **kwargs)
@@ -1,14 +1,28 @@
 import os
-import itertools
+import re
+import hashlib
+import threading
+from uuid import uuid4
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 
+from pymongo.errors import DuplicateKeyError
 from mongoengine import ValidationError
+from mongoengine.fields import ImageField
+from mongoengine.connection import get_db
 
 from django import forms
+from django.conf import settings
 from django.core.validators import EMPTY_VALUES
 from django.core.files.uploadedfile import UploadedFile
 
+from mongotools.compat import find_one_and_update
+from mongotools.dedup import (is_dedup_enabled, get_file_hash, acquire_file,
+                              release_file, release_file_id, dedup_file_attrs)
 from mongotools.forms.fields import DocumentFormFieldGenerator
+from mongotools.renditions import delete_renditions, schedule_renditions
+from mongotools.tenancy import route_proxy
+from mongotools.uploadhandler import GridFSUploadedFile
 
 
 
@@ -49,23 +63,268 @@ def wrap_formfield_clean(formfield, field):
         return result
     formfield.__deepcopy__ = new_deep_copy
 
-def _get_unique_filename(fs, name):
+FILENAME_COUNTERS_COLLECTION = '%s.filename_counters'
+
+def _get_highest_suffix(files, file_root, file_ext):
+    """
+    Returns ``(taken, highest)`` tuple, whether a file named
+    ``<file_root><file_ext>`` exists and the highest numeric suffix of
+    files named like ``<file_root>_<suffix><file_ext>`` (or 0). Uses single
+    anchored regex query which is supported by ``filename`` index of GridFS
+    files collection.
+    """
+    pattern = r'^%s(?:_(\d+))?%s$' % (re.escape(file_root),
+                                       re.escape(file_ext))
+    regex = re.compile(pattern)
+    taken = False
+    highest = 0
+    for f in files.find({'filename': {'$regex': pattern}}, {'filename': 1}):
+        match = regex.match(f['filename'])
+        if match is None:
+            continue
+        if match.group(1) is None:
+            taken = True
+        else:
+            highest = max(highest, int(match.group(1)))
+    return taken, highest
+
+def _get_unique_filename(proxy, name):
+    """
+    Allocates unique ``name`` based file name in GridFS collection of
+    ``proxy``. Highest used suffix of every name is kept in a counter
+    collection and incremented atomically, so allocation costs a single
+    query regardless of the number of files with the same name.
+    """
     file_root, file_ext = os.path.splitext(name)
-    count = itertools.count(1)
-    while fs.exists(filename=name):
-        # file_ext includes the dot.
-        name = os.path.join("%s_%s%s" % (file_root, count.next(), file_ext))
-    return name
-
-def save_file(proxy, file):
-    filename = _get_unique_filename(proxy.fs, file.name)
+    db = get_db(proxy.db_alias)
+    counters = db[FILENAME_COUNTERS_COLLECTION % proxy.collection_name]
+    while True:
+        counter = find_one_and_update(counters, {'_id': name}, {'$inc': {'n': 1}})
+        if counter is not None:
+            break
+        # the first allocation of this name, seed counter from existing files
+        taken, highest = _get_highest_suffix(db[proxy.collection_name].files,
+                                             file_root, file_ext)
+        # ``name`` itself is used if it is free
+        counter = {'_id': name, 'n': highest + 1 if taken else highest}
+        insert = getattr(counters, 'insert_one', None) or counters.insert
+        try:
+            insert(counter)
+        except DuplicateKeyError:
+            # seeded concurrently, retry increment
+            continue
+        if not taken:
+            return name
+        break
+
+    # file_ext includes the dot.
+    return "%s_%s%s" % (file_root, counter['n'], file_ext)
+
+def _unique_filename_strategy(proxy, file):
+    return _get_unique_filename(proxy, file.name)
+
+def _uuid_filename_strategy(proxy, file):
+    return uuid4().hex + os.path.splitext(file.name)[1]
+
+def _hash_filename_strategy(proxy, file):
+    digest = hashlib.sha1()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest() + os.path.splitext(file.name)[1]
+
+FILENAME_STRATEGIES = {
+    'unique': _unique_filename_strategy,
+    'uuid': _uuid_filename_strategy,
+    'hash': _hash_filename_strategy,
+}
+
+def get_filename(proxy, file, strategy=None):
+    """
+    Returns GridFS file name for uploaded ``file``. ``strategy`` is one of:
+
+    * ``'unique'`` - original name made unique with numeric suffix (default)
+    * ``'uuid'`` - random name with original extension
+    * ``'hash'`` - SHA-1 of the content with original extension
+    * callable accepting proxy and uploaded file
+
+    Default strategy can be set with ``MONGOTOOLS_FILENAME_STRATEGY`` setting.
+    """
+    if strategy is None:
+        strategy = getattr(settings, 'MONGOTOOLS_FILENAME_STRATEGY', 'unique')
+    if not callable(strategy):
+        strategy = FILENAME_STRATEGIES[strategy]
+    return strategy(proxy, file)
+
+def store_file(proxy, file, filename_strategy=None, dedup=None):
+    """
+    Stores uploaded ``file`` in GridFS collection of ``proxy`` without
+    assigning it to ``proxy``. Returns id of the stored file, which must be
+    released with `mongotools.dedup.release_file_id` if not used.
+
+    If ``dedup`` is true (defaults to ``MONGOTOOLS_FILE_DEDUP`` setting),
+    already stored file with the same content is reused instead of
+    writing a new one, see `mongotools.dedup`.
+    """
+    digest = None
+    if is_dedup_enabled(dedup):
+        digest = get_file_hash(proxy, file)
+        existing_id = acquire_file(proxy, digest)
+        if existing_id is not None:
+            if isinstance(file, GridFSUploadedFile):
+                file.discard()
+            return existing_id
+
+    filename = get_filename(proxy, file, filename_strategy)
+    extra = dedup_file_attrs(digest) if digest else {}
+    if isinstance(file, GridFSUploadedFile) and file.is_stored_for(proxy):
+        # already streamed to GridFS by `GridFSUploadHandler`
+        file.store(filename, **extra)
+        return file.grid_id
     file.file.seek(0)
-    
-    proxy.replace(file, content_type=file.content_type, filename=filename)
+    grid_id = proxy.fs.put(file, content_type=file.content_type,
+                           filename=filename, **extra)
+    if isinstance(file, GridFSUploadedFile):
+        # copied to another database or collection, the pending upload
+        # is not needed anymore
+        file.discard()
+    return grid_id
+
+def assign_file(proxy, grid_id):
+    proxy.grid_id = grid_id
+    proxy.gridout = None
+    if hasattr(proxy, '_mark_as_changed'):
+        proxy._mark_as_changed()
+
+def replace_file(proxy, grid_id):
+    """
+    Assigns ``grid_id`` file to ``proxy`` and releases its previous file
+    (which may be shared by deduplicated saves). Returns ``True`` if the
+    previous file was deleted.
+    """
+    deleted = release_file(proxy)
+    assign_file(proxy, grid_id)
+    return deleted
+
+def save_file(proxy, file, filename_strategy=None, dedup=None):
+    """
+    Saves uploaded ``file`` to ``proxy`` replacing its previous file,
+    see `store_file`. The file is saved to the current tenant database,
+    see `mongotools.tenancy`.
+    """
+    route_proxy(proxy)
+    replace_file(proxy, store_file(proxy, file, filename_strategy, dedup))
     return proxy
 
-def save_file_field(value, instance, field_name):
+def _update_renditions(instance, field_name, old_id, old_deleted):
+    if isinstance(instance._fields[field_name], ImageField):
+        proxy = instance[field_name]
+        # renditions of deduplicated file are kept while it is used
+        if old_id and old_deleted:
+            delete_renditions(proxy.db_alias, proxy.collection_name, old_id)
+        schedule_renditions(proxy)
+
+def save_file_field(value, instance, field_name, filename_strategy=None,
+                    dedup=None):
+    proxy = route_proxy(instance[field_name])
+    old_id = proxy.grid_id
     if value is False:
-        instance[field_name].delete()
+        old_deleted = release_file(proxy)
     elif isinstance(value, UploadedFile):
-        save_file(instance[field_name], value)
+        grid_id = store_file(proxy, value, filename_strategy, dedup)
+        old_deleted = replace_file(proxy, grid_id)
+    else:
+        return
+    _update_renditions(instance, field_name, old_id, old_deleted)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(
+                getattr(settings, 'MONGOTOOLS_FILE_SAVE_WORKERS', 4))
+    return _pool
+
+class FileBatch(object):
+    """
+    Saves file field values of a document (and its embedded documents)
+    concurrently.
+
+    `write` stores all uploaded files in parallel in a shared pool of
+    ``MONGOTOOLS_FILE_SAVE_WORKERS`` threads and assigns them to the
+    documents only if all of them are stored (already stored files are
+    removed otherwise). Previous files are released by `commit` after
+    the document is saved, or new files are released and previous ones
+    restored by `rollback` if the document save fails.
+    """
+
+    def __init__(self, filename_strategy=None, dedup=None):
+        self.filename_strategy = filename_strategy
+        self.dedup = dedup
+        # (instance, field_name, value) tuples
+        self.changes = []
+        # (instance, field_name, old_id, new_id) tuples
+        self.applied = []
+
+    def add(self, value, instance, field_name):
+        """See `save_file_field`."""
+        if value is False or isinstance(value, UploadedFile):
+            # routed here, as files are stored by other threads
+            route_proxy(instance[field_name])
+            self.changes.append((instance, field_name, value))
+
+    def _store(self, instance, field_name, value):
+        return store_file(instance[field_name], value, self.filename_strategy,
+                          self.dedup)
+
+    def write(self):
+        uploads = [(i, change) for i, change in enumerate(self.changes)
+                   if change[2] is not False]
+        stored = {}
+        error = None
+        if len(uploads) > 1:
+            pool = _get_pool()
+            results = [(i, pool.apply_async(self._store, change))
+                       for i, change in uploads]
+            for i, result in results:
+                try:
+                    stored[i] = result.get()
+                except Exception, e:
+                    error = error or e
+        else:
+            for i, change in uploads:
+                stored[i] = self._store(*change)
+
+        if error is not None:
+            for i, grid_id in stored.items():
+                instance, field_name, value = self.changes[i]
+                proxy = instance[field_name]
+                release_file_id(proxy.db_alias, proxy.collection_name, grid_id)
+            raise error
+
+        for i, (instance, field_name, value) in enumerate(self.changes):
+            proxy = instance[field_name]
+            self.applied.append((instance, field_name, proxy.grid_id,
+                                 stored.get(i)))
+            assign_file(proxy, stored.get(i))
+
+    def commit(self):
+        for instance, field_name, old_id, new_id in self.applied:
+            proxy = instance[field_name]
+            old_deleted = False
+            if old_id:
+                old_deleted = release_file_id(proxy.db_alias,
+                                              proxy.collection_name, old_id)
+            _update_renditions(instance, field_name, old_id, old_deleted)
+        self.applied = []
+
+    def rollback(self):
+        for instance, field_name, old_id, new_id in self.applied:
+            proxy = instance[field_name]
+            if new_id:
+                release_file_id(proxy.db_alias, proxy.collection_name, new_id)
+            assign_file(proxy, old_id)
+        self.applied = []
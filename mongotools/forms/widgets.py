@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
 
+from uuid import uuid4
+
+from mongoengine import signals
+from mongoengine.connection import get_db
 from mongoengine.fields import GridFSProxy
 
-from django.forms.widgets import ClearableFileInput, CheckboxInput
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.forms.widgets import (ClearableFileInput, CheckboxInput, Select,
+                                  SelectMultiple)
 from django.utils.html import escape, conditional_escape
 from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
 
+from mongotools.tenancy import route_proxy
+
 
 
 class ClearableGridFSFileInput(ClearableFileInput):
@@ -35,5 +44,183 @@ class ClearableGridFSFileInput(ClearableFileInput):
         return mark_safe(template % substitutions)
 
     def get_proxy_initial(self, proxy):
+        route_proxy(proxy)
+        metadata = get_proxy_metadata(proxy)
+        if metadata is not None:
+            return escape(force_unicode(metadata['filename']))
         file = proxy.get()
         return escape(force_unicode(file.name))
+
+
+class GridFSMetadataBatch(object):
+    """
+    Lazily fetches metadata of many GridFS files at once.
+
+    Proxies added to a batch get their ``fs.files`` metadata (``filename``,
+    ``length``, ``contentType``) resolved with a single projected ``$in``
+    query per GridFS collection, when metadata of any of them is requested
+    with `get_proxy_metadata` for the first time. Proxies are routed to
+    the current tenant database (see `mongotools.tenancy`).
+    """
+    fields = ('filename', 'length', 'contentType')
+
+    def __init__(self, proxies=()):
+        self.proxies = []
+        self.resolved = False
+        for proxy in proxies:
+            self.add(proxy)
+
+    @classmethod
+    def for_forms(cls, forms):
+        """
+        Returns a batch of files of initial values of all ``forms``
+        (e.g. forms of a formset).
+        """
+        return cls(value for form in forms for value in form.initial.values())
+
+    def add(self, proxy):
+        # `GridFSProxy.__getattr__` fetches the file for unknown attributes,
+        # so `__dict__` is used to access own attributes
+        if isinstance(proxy, GridFSProxy) and proxy.grid_id:
+            proxy.__dict__['_metadata_batch'] = self
+            self.proxies.append(proxy)
+
+    def resolve(self):
+        groups = {}
+        for proxy in self.proxies:
+            route_proxy(proxy)
+            key = (proxy.db_alias, proxy.collection_name)
+            groups.setdefault(key, []).append(proxy)
+
+        projection = dict.fromkeys(self.fields, 1)
+        for (db_alias, collection_name), proxies in groups.items():
+            files = get_db(db_alias)[collection_name].files
+            ids = list(set(proxy.grid_id for proxy in proxies))
+            found = dict((f['_id'], f) for f in
+                         files.find({'_id': {'$in': ids}}, projection))
+            for proxy in proxies:
+                proxy.__dict__['_metadata'] = found.get(proxy.grid_id)
+        self.resolved = True
+
+def get_proxy_metadata(proxy):
+    """
+    Returns ``fs.files`` metadata dict of ``proxy`` file or ``None`` if
+    the file does not exist.
+    """
+    batch = proxy.__dict__.get('_metadata_batch')
+    if batch is None:
+        batch = GridFSMetadataBatch([proxy])
+    if not batch.resolved:
+        batch.resolve()
+    return proxy.__dict__.get('_metadata')
+
+
+CHOICES_VERSION_KEY = 'mongotools:choices:%s'
+CHOICES_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+# versions kept by a process local cache backend are not invalidated in
+# other processes, so they expire soon
+CHOICES_VERSION_LOCAL_TIMEOUT = 60
+MAX_CACHED_CHOICE_SETS = 100
+
+# choice set key -> (version, [(value, option_prefix, option_suffix), ...])
+_options_cache = {}
+
+def get_choices_version_timeout():
+    if isinstance(cache, LocMemCache):
+        return CHOICES_VERSION_LOCAL_TIMEOUT
+    return CHOICES_VERSION_TIMEOUT
+
+def get_choices_version(collection_name):
+    """
+    Returns current version of cached choice sets for documents stored in
+    ``collection_name`` or ``None`` if Django cache is not available.
+    Versions are kept in Django cache, so they are shared between processes
+    if a shared cache backend is configured. With the local memory backend
+    other processes may use stale choices for up to
+    ``CHOICES_VERSION_LOCAL_TIMEOUT`` seconds.
+    """
+    key = CHOICES_VERSION_KEY % collection_name
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, get_choices_version_timeout())
+        version = cache.get(key)
+    return version
+
+def invalidate_choices(collection_name):
+    cache.set(CHOICES_VERSION_KEY % collection_name, uuid4().hex,
+              get_choices_version_timeout())
+
+def _invalidate_choices_handler(sender, document=None, **kwargs):
+    # choice sets may be cached by other processes, so the shared version
+    # is always changed
+    collection_name = getattr(sender, '_get_collection_name', lambda: None)()
+    if collection_name:
+        invalidate_choices(collection_name)
+
+if signals.signals_available:
+    signals.post_save.connect(_invalidate_choices_handler)
+    signals.post_delete.connect(_invalidate_choices_handler)
+
+
+class CachedChoicesMixin(object):
+    """
+    Caches pre-rendered options of `MongoChoiceIterator` choices across
+    renders and requests. Only ``selected`` attributes are patched in on
+    every render.
+
+    Cached options are invalidated by ``post_save`` and ``post_delete``
+    signals of the referenced document class (requires blinker). Bulk
+    `QuerySet.update` calls do not send signals, use `invalidate_choices`
+    after them.
+    """
+
+    def get_choices_document(self):
+        queryset = getattr(self.choices, 'queryset', None)
+        return getattr(queryset, '_document', None)
+
+    def get_choices_cache_key(self):
+        get_key = getattr(self.choices, 'get_cache_key', None)
+        return get_key() if get_key is not None else None
+
+    def get_cached_options(self, key, collection_name):
+        version = get_choices_version(collection_name)
+        cached = _options_cache.get(key)
+        if version is not None and cached is not None and cached[0] == version:
+            return cached[1]
+
+        options = []
+        for option_value, option_label in self.choices:
+            option_value = force_unicode(option_value)
+            options.append((option_value,
+                u'<option value="%s"' % escape(option_value),
+                u'>%s</option>' % conditional_escape(force_unicode(option_label))))
+        if version is not None:
+            if len(_options_cache) >= MAX_CACHED_CHOICE_SETS:
+                _options_cache.clear()
+            _options_cache[key] = (version, options)
+        return options
+
+    def render_options(self, choices, selected_choices):
+        key = self.get_choices_cache_key()
+        if key is None or choices:
+            return super(CachedChoicesMixin, self).render_options(
+                choices, selected_choices)
+
+        options = self.get_cached_options(
+            key, self.get_choices_document()._get_collection_name())
+        selected_choices = set([force_unicode(v) for v in selected_choices])
+        output = []
+        for value, prefix, suffix in options:
+            if value in selected_choices:
+                output.append(prefix + u' selected="selected"' + suffix)
+            else:
+                output.append(prefix + suffix)
+        return u'\n'.join(output)
+
+
+class CachedSelect(CachedChoicesMixin, Select):
+    pass
+
+
+class CachedSelectMultiple(CachedChoicesMixin, SelectMultiple):
+    pass
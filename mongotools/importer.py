@@ -0,0 +1,175 @@
+import csv
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from pymongo.errors import OperationFailure
+try:
+    from pymongo.errors import BulkWriteError
+except ImportError:
+    # pymongo < 2.7
+    BulkWriteError = None
+
+from django.core.exceptions import NON_FIELD_ERRORS
+
+from mongotools.forms.engine import (DocumentFormValidator,
+                                     ParallelDocumentFormValidator)
+
+__all__ = ('iter_csv_rows', 'iter_ndjson_rows', 'ImportResult',
+           'DocumentImporter')
+
+
+
+def iter_csv_rows(fileobj, encoding='utf-8', **fmtparams):
+    """
+    Yields data dicts for rows of CSV ``fileobj`` (opened in binary mode).
+    The first row must contain field names.
+    """
+    reader = csv.reader(fileobj, **fmtparams)
+    header = [h.decode(encoding) for h in reader.next()]
+    for row in reader:
+        yield dict(zip(header, [v.decode(encoding) for v in row]))
+
+def iter_ndjson_rows(fileobj, encoding='utf-8'):
+    """
+    Yields data dicts for every non-empty line of newline delimited
+    JSON ``fileobj``.
+    """
+    for line in fileobj:
+        line = line.strip()
+        if line:
+            yield json.loads(line, encoding=encoding)
+
+
+class ImportResult(object):
+    """
+    Import statistics. At most ``max_errors`` per row errors are kept
+    in ``errors`` as ``(row_number, errors_dict)`` tuples.
+    """
+
+    def __init__(self, max_errors=1000):
+        self.max_errors = max_errors
+        self.rows = 0
+        self.inserted = 0
+        self.invalid = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, row_number, errors):
+        if self.max_errors is None or len(self.errors) < self.max_errors:
+            self.errors.append((row_number, errors))
+
+    def __repr__(self):
+        return ('<ImportResult: rows=%s inserted=%s invalid=%s failed=%s>'
+                % (self.rows, self.inserted, self.invalid, self.failed))
+
+
+class DocumentImporter(object):
+    """
+    Streams data dicts through ``form_class`` validation and inserts valid
+    documents with batched ``insert`` commands.
+
+    Valid documents are inserted in batches of ``batch_size``, so memory
+    usage depends on batch size only. Documents are inserted directly to the collection,
+    i.e. `Document.save` is not called and no signals are sent.
+    ``FileField`` data is not supported.
+
+    If ``ordered`` is true, the import is stopped at the first failed insert
+    (e.g. duplicate key error), otherwise remaining documents are still
+    inserted.
+
+    If ``processes`` is given, rows are validated in a pool of worker
+    processes (see `ParallelDocumentFormValidator`).
+    """
+
+    def __init__(self, form_class, batch_size=1000, ordered=False,
+                 max_errors=1000, processes=None,
+                 validator_class=DocumentFormValidator):
+        self.form_class = form_class
+        self.document = form_class._meta.document
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.max_errors = max_errors
+        self.processes = processes
+        self.validator_class = validator_class
+
+    def iter_validate(self, rows, validator):
+        """
+        Yields ``(son, errors)`` tuples for data dicts of ``rows``.
+        """
+        if isinstance(validator, ParallelDocumentFormValidator):
+            return validator.iter_validate(rows)
+        return ((instance.to_mongo() if instance is not None else None, errors)
+                for instance, errors in validator.iter_validate(rows))
+
+    def get_validator(self):
+        if self.processes:
+            return ParallelDocumentFormValidator(self.form_class,
+                                                 processes=self.processes)
+        return self.validator_class(self.form_class)
+
+    def run(self, rows):
+        """Imports data dicts of ``rows`` and returns `ImportResult`."""
+        result = ImportResult(self.max_errors)
+        validator = self.get_validator()
+        batch = []
+        try:
+            for row_number, (son, errors) in enumerate(
+                    self.iter_validate(rows, validator), 1):
+                result.rows = row_number
+                if errors:
+                    result.invalid += 1
+                    result.add_error(row_number, errors)
+                    continue
+                batch.append((row_number, son))
+                if len(batch) >= self.batch_size:
+                    inserted = self.insert(batch, result)
+                    batch = []
+                    if not inserted and self.ordered:
+                        break
+            if batch:
+                self.insert(batch, result)
+        finally:
+            if hasattr(validator, 'terminate'):
+                validator.terminate()
+        return result
+
+    def insert(self, batch, result):
+        """
+        Inserts ``(row_number, son)`` tuples of ``batch``.
+        Returns ``False`` if any document failed to insert.
+        """
+        collection = self.document._get_collection()
+        docs = [son for row_number, son in batch]
+        if hasattr(collection, 'insert_many'):
+            # pymongo 3+
+            try:
+                collection.insert_many(docs, ordered=self.ordered)
+            except BulkWriteError, e:
+                write_errors = e.details.get('writeErrors', [])
+                result.inserted += e.details.get('nInserted', 0)
+                result.failed += len(batch) - e.details.get('nInserted', 0)
+                for error in write_errors:
+                    row_number = batch[error['index']][0]
+                    result.add_error(row_number, {NON_FIELD_ERRORS: [error['errmsg']]})
+                return False
+        else:
+            try:
+                collection.insert(docs, continue_on_error=not self.ordered)
+            except OperationFailure, e:
+                # pymongo 2 does not report failed documents, so the error
+                # is assigned to the first row of the batch
+                inserted = self.count_inserted(docs)
+                result.inserted += inserted
+                result.failed += len(batch) - inserted
+                result.add_error(batch[0][0], {NON_FIELD_ERRORS: [unicode(e)]})
+                return False
+        result.inserted += len(batch)
+        return True
+
+    def count_inserted(self, docs):
+        ids = [son['_id'] for son in docs if '_id' in son]
+        collection = self.document._get_collection()
+        return collection.find({'_id': {'$in': ids}}).count()
@@ -0,0 +1,208 @@
+"""
+Explain-plan checks of querysets used by mongotools views and forms.
+
+Querysets are explained with the database they are configured for (use a
+local copy of the production data) and flagged if the winning plan scans
+the whole collection (``COLLSCAN``) or sorts documents in memory
+(``SORT``). Every flagged query shape comes with an index suggestion in
+`Document` ``meta['indexes']`` syntax.
+
+With ``MONGOTOOLS_INDEX_ADVISOR = True`` setting (for development or
+test runs), querysets of `MongoMultipleObjectMixin.get_queryset`,
+`MongoSingleObjectMixin.get_object` and `MongoChoiceIterator` are
+checked as they are used and flagged ones are reported with
+`UnindexedQueryWarning` (run tests with
+``-W error::mongotools.indexadvisor.UnindexedQueryWarning`` to fail on
+them). The ``adviseindexes`` management command checks views and forms
+without requests.
+"""
+import warnings
+
+from django.conf import settings
+
+__all__ = ('UnindexedQueryWarning', 'IndexAdvice', 'advise_queryset',
+           'collect_queryset')
+
+
+class UnindexedQueryWarning(UserWarning):
+    pass
+
+
+class IndexAdvice(object):
+    """Explain-plan check result of a queryset used by ``source``."""
+
+    def __init__(self, source, document, query, ordering, problems,
+                 suggestion):
+        self.source = source
+        self.document = document
+        self.query = query
+        self.ordering = ordering
+        self.problems = problems
+        self.suggestion = suggestion
+
+    def get_index_spec(self):
+        """
+        Returns ``meta['indexes']`` entry of the suggested index or ``None``
+        if no index can be suggested (e.g. for ``$or`` queries).
+        """
+        if not self.suggestion:
+            return None
+        if len(self.suggestion) == 1:
+            return self.suggestion[0]
+        return tuple(self.suggestion)
+
+    def __unicode__(self):
+        return u"%s: %s query %r ordered by %r (%s), suggested index: %r" % (
+            self.source, self.document.__name__, self.query, self.ordering,
+            ', '.join(self.problems), self.get_index_spec())
+
+
+def get_source_name(obj):
+    cls = obj if isinstance(obj, type) else obj.__class__
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+def get_ordering(queryset):
+    """Returns effective ``[(db_field, direction), ...]`` ordering."""
+    ordering = getattr(queryset, '_ordering', None)
+    if ordering is None:
+        meta_ordering = queryset._document._meta.get('ordering') or []
+        ordering = queryset.clone().order_by(*meta_ordering)._ordering
+    return list(ordering or [])
+
+def get_plan_problems(explain):
+    """Returns a list of ``'COLLSCAN'`` and ``'SORT'`` stages of a plan."""
+    problems = set()
+    planner = explain.get('queryPlanner')
+    if planner is not None:
+        stages = [planner['winningPlan']]
+        while stages:
+            stage = stages.pop()
+            if stage.get('stage') in ('COLLSCAN', 'SORT'):
+                problems.add(stage['stage'])
+            if 'inputStage' in stage:
+                stages.append(stage['inputStage'])
+            stages.extend(stage.get('inputStages', []))
+    else:
+        # MongoDB < 3.0
+        if explain.get('cursor', '').startswith('BasicCursor'):
+            problems.add('COLLSCAN')
+        if explain.get('scanAndOrder'):
+            problems.add('SORT')
+    return sorted(problems)
+
+def suggest_index(document, query, ordering):
+    """
+    Returns an index specification (list of ``[+-]field`` names) supporting
+    ``query`` and ``ordering``: equality fields, then sort fields, then
+    range fields.
+    """
+    names = dict((f.db_field, name) for name, f in document._fields.items())
+    equality = []
+    ranges = []
+    for key, value in query.items():
+        if key.startswith('$'):
+            # ``$or``, ``$text``...
+            continue
+        operators = isinstance(value, dict) and [
+            k for k in value if k.startswith('$')]
+        if operators and set(operators) - set(['$in', '$eq', '$all']):
+            ranges.append(key)
+        else:
+            equality.append(key)
+    sort_keys = [key for key, direction in ordering]
+    spec = [(key, 1) for key in sorted(equality)]
+    spec.extend((key, direction) for key, direction in ordering
+                if key not in equality)
+    spec.extend((key, 1) for key in sorted(ranges) if key not in sort_keys)
+    return ['%s%s' % ('-' if direction < 0 else '', names.get(key, key))
+            for key, direction in spec]
+
+def get_query_shape(queryset):
+    """Returns hashable shape of the query (values are not included)."""
+    def shape(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, shape(v)) for k, v in value.items()
+                                if k.startswith('$') or isinstance(v, dict)))
+        return None
+    return (queryset._document._get_collection_name(),
+            tuple(sorted((k, shape(v)) for k, v in queryset._query.items())),
+            tuple(get_ordering(queryset)))
+
+def advise_queryset(source, queryset):
+    """
+    Explains ``queryset`` and returns `IndexAdvice` if it is not
+    supported by an index, otherwise ``None``. Unfiltered full scans are
+    not flagged.
+    """
+    query = queryset._query
+    ordering = get_ordering(queryset)
+    explain = queryset.clone()._cursor.explain()
+    problems = get_plan_problems(explain)
+    if not query and 'COLLSCAN' in problems:
+        problems.remove('COLLSCAN')
+    if not problems:
+        return None
+    document = queryset._document
+    return IndexAdvice(source, document, query, ordering, problems,
+                       suggest_index(document, query, ordering))
+
+# query shapes checked by `collect_queryset`
+_checked_shapes = set()
+
+def collect_queryset(source, queryset):
+    """
+    Checks ``queryset`` used by ``source`` with `advise_queryset` if
+    ``MONGOTOOLS_INDEX_ADVISOR`` setting is true. Every query shape is
+    checked once per process.
+    """
+    if not getattr(settings, 'MONGOTOOLS_INDEX_ADVISOR', False):
+        return
+    shape = get_query_shape(queryset)
+    if shape in _checked_shapes:
+        return
+    _checked_shapes.add(shape)
+    advice = advise_queryset(source, queryset)
+    if advice is not None:
+        warnings.warn(unicode(advice), UnindexedQueryWarning)
+
+def iter_document_querysets():
+    """
+    Yields ``(source, queryset)`` tuples of default querysets (with
+    ``meta['ordering']``) of registered documents, which are also used by
+    reference field choices.
+    """
+    # imported here, as `mongotools.forms` uses this module
+    from mongotools.orphans import _iter_documents
+    for document in _iter_documents():
+        yield get_source_name(document), document.objects
+
+def iter_view_querysets(view_class):
+    """
+    Yields ``(source, queryset)`` tuples of querysets of ``view_class``
+    instantiated with a bare GET request: the object list and the slug
+    lookup of single object views.
+    """
+    from django.test.client import RequestFactory
+    from mongotools.views import (MongoMultipleObjectMixin,
+                                  MongoSingleObjectMixin, StreamedObjectList)
+    view = view_class()
+    view.request = RequestFactory().get('/')
+    view.args = ()
+    view.kwargs = {}
+    source = get_source_name(view_class)
+    queryset = view.get_queryset()
+    if isinstance(queryset, StreamedObjectList):
+        queryset = queryset.queryset
+    if isinstance(view, MongoMultipleObjectMixin):
+        yield source, queryset
+    elif isinstance(view, MongoSingleObjectMixin):
+        slug_field = view.get_slug_field()
+        if slug_field in queryset._document._fields:
+            yield source, queryset.filter(**{slug_field: ''})
+
+def iter_form_querysets(form_class):
+    """Yields ``(source, queryset)`` tuples of choice querysets of a form."""
+    for name, field in form_class.base_fields.items():
+        queryset = getattr(field, 'queryset', None)
+        if queryset is not None and hasattr(queryset, '_document'):
+            yield '%s.%s' % (get_source_name(form_class), name), queryset
@@ -0,0 +1,67 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.importlib import import_module
+
+from mongotools.indexadvisor import (advise_queryset, get_query_shape,
+                                     iter_document_querysets,
+                                     iter_view_querysets, iter_form_querysets)
+
+
+
+class Command(BaseCommand):
+    args = '[view or form class path ...]'
+    help = ('Explains querysets of registered documents and of given views'
+            ' and forms, reports queries which scan whole collections or'
+            ' sort in memory and suggests indexes for them. All document'
+            ' modules must be imported (e.g. by INSTALLED_APPS).')
+    option_list = BaseCommand.option_list + (
+        make_option('--fail', dest='fail', action='store_true',
+                    default=False,
+                    help='Exit with an error if any query is reported.'),
+    )
+
+    def import_class(self, path):
+        module_name, sep, name = path.rpartition('.')
+        try:
+            return getattr(import_module(module_name), name)
+        except (ImportError, AttributeError, ValueError):
+            raise CommandError('Can not import "%s"' % path)
+
+    def iter_querysets(self, paths):
+        for item in iter_document_querysets():
+            yield item
+        for path in paths:
+            cls = self.import_class(path)
+            if hasattr(cls, 'base_fields'):
+                querysets = iter_form_querysets(cls)
+            elif hasattr(cls, 'get_queryset'):
+                querysets = iter_view_querysets(cls)
+            else:
+                raise CommandError('"%s" is not a view or form' % path)
+            for item in querysets:
+                yield item
+
+    def handle(self, *args, **options):
+        shapes = set()
+        advices = []
+        for source, queryset in self.iter_querysets(args):
+            shape = get_query_shape(queryset)
+            if shape in shapes:
+                continue
+            shapes.add(shape)
+            advice = advise_queryset(source, queryset)
+            if advice is not None:
+                advices.append(advice)
+
+        for advice in advices:
+            self.stdout.write('%s: %s %s ordered by %s\n' % (
+                advice.source, ', '.join(advice.problems), advice.query,
+                advice.ordering))
+            spec = advice.get_index_spec()
+            if spec is not None:
+                self.stdout.write('  suggested: %s.meta["indexes"] += [%r]\n'
+                                  % (advice.document.__name__, spec))
+        self.stdout.write('%s unindexed queries found.\n' % len(advices))
+        if advices and options['fail']:
+            raise CommandError('Unindexed queries found.')
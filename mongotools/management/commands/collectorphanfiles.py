@@ -0,0 +1,54 @@
+from datetime import timedelta
+from optparse import make_option
+
+from mongoengine.connection import DEFAULT_CONNECTION_NAME
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mongotools.orphans import collect_orphaned_files
+from mongotools.warmup import import_class
+
+
+
+class Command(BaseCommand):
+    args = '[app path ...]'
+    help = ('Finds (and with --delete deletes) GridFS files which are not'
+            ' referenced by documents of given apps or --document classes.'
+            ' All documents referencing the files must be covered.')
+    option_list = BaseCommand.option_list + (
+        make_option('--document', dest='documents', action='append',
+                    default=[], help='Path of a document class referencing'
+                                     ' the files (repeatable).'),
+        make_option('--db-alias', dest='db_alias',
+                    default=DEFAULT_CONNECTION_NAME,
+                    help='Database alias of the GridFS collection.'),
+        make_option('--collection', dest='collection', default='fs',
+                    help='GridFS collection name.'),
+        make_option('--min-age', dest='min_age', type='float', default=24,
+                    help='Keep files uploaded less than this number of'
+                         ' hours ago.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=1000, help='Number of files deleted at once.'),
+        make_option('--sleep', dest='sleep', type='float', default=0,
+                    help='Pause between batches in seconds.'),
+        make_option('--delete', dest='delete', action='store_true',
+                    default=False,
+                    help='Delete orphaned files, they are only reported'
+                         ' otherwise.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            documents = [import_class(path) for path in options['documents']]
+            orphans = collect_orphaned_files(
+                options['db_alias'], options['collection'],
+                documents=documents, apps=args,
+                min_age=timedelta(hours=options['min_age']),
+                batch_size=options['batch_size'], sleep=options['sleep'],
+                dry_run=not options['delete'])
+        except (ImportError, AttributeError, ValueError), e:
+            raise CommandError(e)
+        if not options['delete']:
+            self.stdout.write('%s orphaned files found.\n' % len(orphans))
+        else:
+            self.stdout.write('%s orphaned files deleted.\n' % len(orphans))
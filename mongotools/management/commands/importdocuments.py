@@ -0,0 +1,88 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import smart_str
+from django.utils.importlib import import_module
+
+from mongotools.forms import BaseDocumentForm, documentform_factory
+from mongotools.importer import (DocumentImporter, iter_csv_rows,
+                                 iter_ndjson_rows)
+
+
+
+def import_by_path(path):
+    module_path, _, name = path.rpartition('.')
+    try:
+        return getattr(import_module(module_path), name)
+    except (ImportError, AttributeError, ValueError), e:
+        raise CommandError('Could not import "%s": %s' % (path, e))
+
+def get_form_class(path):
+    """
+    Returns form class for dotted ``path`` to either a document form class
+    or a document class.
+    """
+    cls = import_by_path(path)
+    if isinstance(cls, type) and issubclass(cls, BaseDocumentForm):
+        return cls
+    if hasattr(cls, '_fields'):
+        return documentform_factory(cls)
+    raise CommandError('"%s" is neither document form nor document class'
+                       % path)
+
+
+class Command(BaseCommand):
+    args = '<form_or_document> <file>'
+    help = ('Imports CSV or newline delimited JSON file into a collection'
+            ' validating every row with a document form.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+                    choices=('csv', 'ndjson'),
+                    help='Input format. Guessed from file extension by default.'),
+        make_option('--encoding', dest='encoding', default='utf-8',
+                    help='Input file encoding.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=1000, help='Number of rows per insert batch.'),
+        make_option('--ordered', dest='ordered', action='store_true',
+                    default=False,
+                    help='Stop the import at the first failed insert.'),
+        make_option('--processes', dest='processes', type='int',
+                    default=None,
+                    help='Number of validation worker processes.'),
+        make_option('--max-errors', dest='max_errors', type='int',
+                    default=1000, help='Maximal number of reported row errors.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: %s %s' % ('importdocuments', self.args))
+        form_class = get_form_class(args[0])
+        filename = args[1]
+
+        format = options['format']
+        if format is None:
+            format = 'csv' if filename.lower().endswith('.csv') else 'ndjson'
+        reader = iter_csv_rows if format == 'csv' else iter_ndjson_rows
+
+        importer = DocumentImporter(form_class,
+                                    batch_size=options['batch_size'],
+                                    ordered=options['ordered'],
+                                    max_errors=options['max_errors'],
+                                    processes=options['processes'])
+        try:
+            fileobj = open(filename, 'rb')
+        except IOError, e:
+            raise CommandError(e)
+        try:
+            result = importer.run(reader(fileobj, encoding=options['encoding']))
+        finally:
+            fileobj.close()
+
+        for row_number, errors in result.errors:
+            for field, messages in errors.items():
+                for message in messages:
+                    self.stderr.write(smart_str(u'Row %s: %s: %s\n'
+                                      % (row_number, field, message)))
+        self.stdout.write('%s rows processed, %s inserted, %s invalid,'
+                          ' %s failed.\n' % (result.rows, result.inserted,
+                                              result.invalid, result.failed))
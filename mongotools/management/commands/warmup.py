@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mongotools.warmup import import_class, get_registered, warm_up
+
+
+
+class Command(BaseCommand):
+    args = '[view or form class path ...]'
+    help = ('Warms up registered (or given) views and forms: builds form'
+            ' classes, prefills shared choice caches and loads templates.')
+
+    def handle(self, *args, **options):
+        try:
+            classes = [import_class(path) for path in args] or get_registered()
+        except (ImportError, AttributeError, ValueError), e:
+            raise CommandError(e)
+        stats = warm_up(classes)
+        for cls, e in stats['errors']:
+            self.stderr.write('%s.%s failed: %s\n' % (cls.__module__,
+                                                      cls.__name__, e))
+        self.stdout.write('%s classes warmed up: %s forms, %s choice sets,'
+                          ' %s templates, %s failed.\n' % (
+            len(classes), stats['forms'], stats['choices'],
+            stats['templates'], len(stats['errors'])))
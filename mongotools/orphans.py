@@ -0,0 +1,235 @@
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from mongoengine.base import _document_registry
+from mongoengine.connection import get_db, DEFAULT_CONNECTION_NAME
+from mongoengine.fields import (FileField, ImageField, EmbeddedDocumentField,
+                                ListField)
+
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
+
+from mongotools.compat import delete_many, update_many
+from mongotools.dedup import REFCOUNT_KEY, ACQUIRED_KEY, release_file
+from mongotools.forms.engine import chunked
+from mongotools.renditions import (RENDITIONS_COLLECTION, delete_renditions,
+                                   delete_renditions_many)
+from mongotools.tenancy import route_alias, route_proxy, tenant
+
+__all__ = ('get_file_field_paths', 'iter_file_proxies',
+           'release_document_files', 'get_app_documents',
+           'collect_referenced_ids', 'collect_orphaned_files')
+
+
+
+def get_file_field_paths(document, prefix=''):
+    """
+    Yields ``(path, field)`` tuples for `FileField`s of ``document`` class,
+    including ones in (lists of) embedded documents. ``path`` is a dotted
+    path of db field names.
+    """
+    for name, f in document._fields.items():
+        path = prefix + f.db_field
+        if isinstance(f, ListField) and f.field is not None:
+            f = f.field
+        if isinstance(f, FileField):
+            yield path, f
+        elif isinstance(f, EmbeddedDocumentField):
+            for item in get_file_field_paths(f.document_type, path + '.'):
+                yield item
+
+def iter_file_proxies(doc):
+    """
+    Yields ``(proxy, field)`` tuples for all files of ``doc`` instance,
+    including ones in (lists of) embedded documents.
+    """
+    for name, f in doc._fields.items():
+        value = doc._data.get(name)
+        if value is None:
+            continue
+        values = [value]
+        if isinstance(f, ListField) and f.field is not None:
+            f, values = f.field, value
+        for value in values:
+            if isinstance(f, FileField):
+                if value:
+                    yield value, f
+            elif isinstance(f, EmbeddedDocumentField) and value is not None:
+                for item in iter_file_proxies(value):
+                    yield item
+
+def release_document_files(doc):
+    """
+    Releases all files of (deleted) ``doc`` instance and renditions of
+    its deleted images, see `mongotools.dedup.release_file`. Files are
+    released in the current tenant database.
+    """
+    for proxy, f in iter_file_proxies(doc):
+        route_proxy(proxy)
+        grid_id = proxy.grid_id
+        if release_file(proxy) and isinstance(f, ImageField):
+            delete_renditions(proxy.db_alias, proxy.collection_name, grid_id)
+
+def _iter_documents():
+    """Yields document classes stored in own collections."""
+    for document in _document_registry.values():
+        meta = getattr(document, '_meta', {})
+        if meta.get('abstract') or not hasattr(document, '_get_collection'):
+            continue
+        yield document
+
+def get_app_documents(apps):
+    """
+    Imports ``models`` and ``documents`` modules of ``apps`` (module paths
+    like in ``INSTALLED_APPS``) and returns document classes defined in
+    the apps.
+    """
+    for app in apps:
+        module = import_module(app)
+        for name in ('models', 'documents'):
+            if module_has_submodule(module, name):
+                import_module('%s.%s' % (app, name))
+    return [document for document in _iter_documents()
+            if any(document.__module__ == app or
+                   document.__module__.startswith(app + '.') for app in apps)]
+
+def _extract_ids(value, parts):
+    if isinstance(value, list):
+        for item in value:
+            for grid_id in _extract_ids(item, parts):
+                yield grid_id
+    elif not parts:
+        if value is not None:
+            yield value
+    elif isinstance(value, dict):
+        for grid_id in _extract_ids(value.get(parts[0]), parts[1:]):
+            yield grid_id
+
+def collect_referenced_ids(db_alias, collection_name, documents=None):
+    """
+    Returns a set of ids of files in ``collection_name`` GridFS collection
+    of ``db_alias`` database referenced by documents of all registered (or
+    given) document classes, including thumbnails of referenced images.
+    Only file fields are fetched from documents.
+
+    Aliases of documents and file fields are resolved for ``db_alias`` as
+    the current tenant (see `mongotools.tenancy`), so tenant databases
+    are scanned for their own files. Raises `ValueError` if no file field
+    of the documents uses the collection.
+    """
+    # collection -> set of file field paths
+    paths = {}
+    images = False
+    with tenant(db_alias):
+        for document in documents or _iter_documents():
+            document_alias = route_alias(document._meta.get('db_alias') or
+                                         DEFAULT_CONNECTION_NAME)
+            for path, f in get_file_field_paths(document):
+                if (route_alias(f.db_alias), f.collection_name) != \
+                        (db_alias, collection_name):
+                    continue
+                collection = get_db(document_alias)[
+                    document._get_collection_name()]
+                key = (collection.database.name, collection.name)
+                paths.setdefault(key, (collection, set()))[1].add(path)
+                if isinstance(f, ImageField):
+                    images = True
+    if not paths:
+        raise ValueError('No file fields of the documents use %s collection'
+                         ' of %s database' % (collection_name, db_alias))
+
+    referenced = set()
+    for collection, field_paths in paths.values():
+        projection = dict.fromkeys(field_paths, 1)
+        field_parts = [path.split('.') for path in field_paths]
+        for raw in collection.find({}, projection):
+            for parts in field_parts:
+                referenced.update(_extract_ids(raw, parts))
+    if images:
+        # thumbnails of `ImageField`s are referenced by their images only
+        files = get_db(db_alias)[collection_name].files
+        for batch in chunked(list(referenced), 1000):
+            referenced.update(f['thumbnail_id'] for f in files.find(
+                {'_id': {'$in': batch}, 'thumbnail_id': {'$exists': True}},
+                {'thumbnail_id': 1}))
+    return referenced
+
+def find_orphaned_chunks(db_alias, collection_name, created_before):
+    """
+    Returns ids of files created before ``created_before`` whose chunks
+    are stored without a files document (e.g. interrupted writes).
+    """
+    collection = get_db(db_alias)[collection_name]
+    ids = [c['files_id'] for c in collection.chunks.find(
+        {'n': 0, 'files_id': {'$lt': ObjectId.from_datetime(created_before)}},
+        {'files_id': 1})]
+    orphans = []
+    for batch in chunked(ids, 1000):
+        stored = set(f['_id'] for f in
+                     collection.files.find({'_id': {'$in': batch}}, {'_id': 1}))
+        orphans.extend(grid_id for grid_id in batch if grid_id not in stored)
+    return orphans
+
+def collect_orphaned_files(db_alias=DEFAULT_CONNECTION_NAME,
+                           collection_name='fs', documents=None, apps=None,
+                           min_age=timedelta(days=1), batch_size=1000,
+                           sleep=0, dry_run=True):
+    """
+    Finds files of ``collection_name`` GridFS collection which are not
+    referenced by any of ``documents`` (document classes) or documents of
+    ``apps`` (see `get_app_documents`) and, unless ``dry_run`` (the
+    default), deletes them in batches of ``batch_size`` files with
+    ``sleep`` seconds pause between batches. All documents referencing
+    the collection must be given, files of other documents are deleted.
+
+    Files uploaded or deduplicated saves reusing them less than
+    ``min_age`` ago are kept, as they may belong to documents being saved.
+    Chunks of files without a files document (interrupted writes) are
+    collected too. Returns a list of orphaned file ids.
+    """
+    if collection_name.endswith(RENDITIONS_COLLECTION % ''):
+        raise ValueError('Renditions are collected with their source files')
+    if not documents and not apps:
+        raise ValueError('Documents or apps referencing the files must be'
+                         ' given')
+    documents = list(documents or []) + get_app_documents(apps or [])
+    db = get_db(db_alias)
+    files = db[collection_name].files
+    chunks = db[collection_name].chunks
+
+    created_before = datetime.utcnow() - min_age
+    recent = {'$not': {'$gte': created_before}}
+    candidates = [f['_id'] for f in
+                  files.find({'uploadDate': {'$lt': created_before},
+                              ACQUIRED_KEY: recent}, {'_id': 1})]
+    referenced = collect_referenced_ids(db_alias, collection_name, documents)
+    orphans = [grid_id for grid_id in candidates if grid_id not in referenced]
+    chunk_orphans = find_orphaned_chunks(db_alias, collection_name,
+                                         created_before)
+    if dry_run:
+        return orphans + chunk_orphans
+
+    deleted = []
+    for i, batch in enumerate(chunked(orphans, batch_size)):
+        if i and sleep:
+            time.sleep(sleep)
+        spec = {'_id': {'$in': batch}}
+        # deduplicated files which were not reused since they were listed
+        # are protected from reuse (their reference count is reset)
+        update_many(files, dict(spec, **{REFCOUNT_KEY: {'$gt': 0},
+                                         ACQUIRED_KEY: recent}),
+                    {'$set': {REFCOUNT_KEY: 0}})
+        batch = [f['_id'] for f in files.find(
+            dict(spec, **{REFCOUNT_KEY: {'$not': {'$gt': 0}}}), {'_id': 1})]
+        if not batch:
+            continue
+        spec = {'_id': {'$in': batch}}
+        delete_many(files, spec)
+        delete_many(chunks, {'files_id': {'$in': batch}})
+        delete_renditions_many(db_alias, collection_name, batch)
+        deleted.extend(batch)
+    for batch in chunked(chunk_orphans, batch_size):
+        delete_many(chunks, {'files_id': {'$in': batch}})
+        deleted.extend(batch)
+    return deleted
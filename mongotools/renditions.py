@@ -0,0 +1,241 @@
+"""
+Resized variants (renditions) of GridFS images.
+
+Renditions are produced for named size presets configured with
+``MONGOTOOLS_RENDITIONS`` setting, e.g.::
+
+    MONGOTOOLS_RENDITIONS = {
+        'thumb': {'size': (100, 100), 'crop': True},
+        'large': {'size': (1024, 1024), 'format': 'JPEG', 'eager': True},
+    }
+
+and stored as GridFS files in ``<collection>_renditions`` collection keyed
+by source file id and preset name. Renditions are generated in a pool of
+``MONGOTOOLS_RENDITION_WORKERS`` background threads, either right after
+the source image is saved by `save_file_field` (``eager`` presets) or on
+the first request of a missing rendition, and deleted when the source
+image is replaced or deleted.
+"""
+import logging
+import threading
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from bson import ObjectId
+from gridfs import GridFS
+from gridfs.errors import FileExists
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    try:
+        import Image, ImageOps
+    except ImportError:
+        Image = ImageOps = None
+from mongoengine.connection import get_db
+from pymongo.errors import OperationFailure
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from mongotools.compat import aggregate
+
+__all__ = ('RenditionPreset', 'get_preset', 'get_rendition',
+           'generate_rendition', 'schedule_rendition', 'schedule_renditions',
+           'delete_renditions', 'delete_renditions_many')
+
+RENDITIONS_COLLECTION = '%s_renditions'
+
+logger = logging.getLogger('mongotools.renditions')
+
+
+
+class RenditionPreset(object):
+    """
+    Image size preset. Images are downscaled to fit in ``size`` keeping
+    aspect ratio or, if ``crop`` is true, scaled and cropped to exactly
+    ``size``. Source image format is kept if ``format`` is not given.
+    """
+
+    def __init__(self, name, size, crop=False, format=None, quality=85,
+                 eager=False):
+        self.name = name
+        self.size = tuple(size)
+        self.crop = crop
+        self.format = format
+        self.quality = quality
+        self.eager = eager
+
+    def process(self, image):
+        """Returns resized PIL ``image``."""
+        if self.crop:
+            return ImageOps.fit(image, self.size, Image.ANTIALIAS)
+        image = image.copy()
+        image.thumbnail(self.size, Image.ANTIALIAS)
+        return image
+
+    def render(self, data):
+        """
+        Returns ``(content, content_type)`` tuple of rendition of image
+        ``data``.
+        """
+        if Image is None:
+            raise ImproperlyConfigured('PIL is required for image renditions')
+        image = Image.open(StringIO(data))
+        format = (self.format or image.format or 'JPEG').upper()
+        image = self.process(image)
+        if format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = StringIO()
+        image.save(out, format, quality=self.quality)
+        return out.getvalue(), 'image/%s' % format.lower()
+
+_presets = None
+
+def get_presets():
+    global _presets
+    if _presets is None:
+        _presets = dict(
+            (name, RenditionPreset(name, **options)) for name, options in
+            getattr(settings, 'MONGOTOOLS_RENDITIONS', {}).items())
+    return _presets
+
+def get_preset(name):
+    try:
+        return get_presets()[name]
+    except KeyError:
+        raise ValueError('Unknown rendition preset "%s"' % name)
+
+
+RENDITION_KEY = [('source_id', 1), ('preset', 1)]
+
+_indexed_collections = set()
+
+def _remove_duplicates(collection, fs):
+    """Deletes all but the newest rendition of every source and preset."""
+    duplicates = aggregate(collection.files, [
+        {'$sort': {'uploadDate': -1}},
+        {'$group': {'_id': {'source_id': '$source_id', 'preset': '$preset'},
+                    'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ])
+    for group in duplicates:
+        for file_id in group['ids'][1:]:
+            fs.delete(file_id)
+
+def _ensure_unique_index(collection, fs):
+    try:
+        collection.files.create_index(RENDITION_KEY, unique=True)
+    except OperationFailure:
+        # renditions stored before the index was unique
+        _remove_duplicates(collection, fs)
+        for name, info in collection.files.index_information().items():
+            key = [(k, int(d)) for k, d in info['key']]
+            if key == RENDITION_KEY and not info.get('unique'):
+                collection.files.drop_index(name)
+        collection.files.create_index(RENDITION_KEY, unique=True)
+
+def _get_renditions_fs(db_alias, collection_name):
+    db = get_db(db_alias)
+    name = RENDITIONS_COLLECTION % collection_name
+    fs = GridFS(db, name)
+    if (db_alias, name) not in _indexed_collections:
+        _ensure_unique_index(db[name], fs)
+        _indexed_collections.add((db_alias, name))
+    return db[name], fs
+
+def get_rendition(db_alias, collection_name, source_id, preset_name):
+    """
+    Returns `GridOut` of stored rendition or ``None`` if it is not
+    generated yet.
+    """
+    collection, fs = _get_renditions_fs(db_alias, collection_name)
+    spec = {'source_id': source_id, 'preset': preset_name}
+    f = collection.files.find_one(spec, {'_id': 1})
+    return fs.get(f['_id']) if f is not None else None
+
+def generate_rendition(db_alias, collection_name, source_id, preset_name):
+    """
+    Generates and stores rendition of ``source_id`` image for
+    ``preset_name`` preset. Returns id of the stored rendition or ``None``
+    if the source file does not exist. If the rendition is stored
+    concurrently by another process, the generated one is discarded and
+    id of the stored one is returned.
+    """
+    preset = get_preset(preset_name)
+    db = get_db(db_alias)
+    source_fs = GridFS(db, collection_name)
+    if not source_fs.exists(source_id):
+        return None
+    source = source_fs.get(source_id)
+    content, content_type = preset.render(source.read())
+    collection, fs = _get_renditions_fs(db_alias, collection_name)
+    file_id = ObjectId()
+    try:
+        return fs.put(content, _id=file_id,
+                      filename='%s_%s' % (preset_name, source.filename),
+                      content_type=content_type, source_id=source_id,
+                      preset=preset_name)
+    except FileExists:
+        # raised by `GridIn` for duplicate key of the files document, its
+        # chunks are written before
+        fs.delete(file_id)
+        existing = collection.files.find_one(
+            {'source_id': source_id, 'preset': preset_name}, {'_id': 1})
+        return existing['_id'] if existing is not None else None
+
+_pool = None
+_pool_lock = threading.Lock()
+# keys of renditions being generated
+_pending = set()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(
+                getattr(settings, 'MONGOTOOLS_RENDITION_WORKERS', 2))
+    return _pool
+
+def _generate(key):
+    try:
+        generate_rendition(*key)
+    except Exception:
+        logger.exception('Rendition %r generation failed', key)
+    finally:
+        with _pool_lock:
+            _pending.discard(key)
+
+def schedule_rendition(db_alias, collection_name, source_id, preset_name):
+    """
+    Schedules background generation of the rendition unless it is being
+    generated already.
+    """
+    key = (db_alias, collection_name, source_id, preset_name)
+    with _pool_lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+    _get_pool().apply_async(_generate, (key,))
+
+def schedule_renditions(proxy, eager_only=True):
+    """
+    Schedules generation of renditions of ``proxy`` image for all
+    presets (or only for ``eager`` presets).
+    """
+    if not proxy.grid_id:
+        return
+    for preset in get_presets().values():
+        if preset.eager or not eager_only:
+            schedule_rendition(proxy.db_alias, proxy.collection_name,
+                               proxy.grid_id, preset.name)
+
+def delete_renditions(db_alias, collection_name, source_id):
+    """Deletes all renditions of ``source_id`` image."""
+    delete_renditions_many(db_alias, collection_name, [source_id])
+
+def delete_renditions_many(db_alias, collection_name, source_ids):
+    """Deletes all renditions of images with ids in ``source_ids``."""
+    collection, fs = _get_renditions_fs(db_alias, collection_name)
+    spec = {'source_id': {'$in': list(source_ids)}}
+    for f in collection.files.find(spec, {'_id': 1}):
+        fs.delete(f['_id'])
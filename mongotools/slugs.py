@@ -0,0 +1,94 @@
+import re
+
+from mongoengine import NotUniqueError
+
+from django.template.defaultfilters import slugify
+
+__all__ = ('get_highest_slug_suffix', 'allocate_slug',
+           'save_with_unique_slug', 'UniqueSlugMixin')
+
+
+
+def get_highest_slug_suffix(collection, db_field, base):
+    """
+    Returns the highest numeric suffix of ``db_field`` values like
+    ``<base>-<suffix>`` (1 for ``<base>``) or 0 if ``<base>`` itself is
+    not taken. Uses single anchored regex query projected to ``db_field``
+    only, so it is covered by an index of the field.
+    """
+    pattern = r'^%s(?:-(\d+))?$' % re.escape(base)
+    regex = re.compile(pattern)
+    taken = False
+    highest = 1
+    for doc in collection.find({db_field: {'$regex': pattern}},
+                               {db_field: 1, '_id': 0}):
+        match = regex.match(doc.get(db_field) or '')
+        if match is None:
+            continue
+        if match.group(1) is None:
+            taken = True
+        else:
+            highest = max(highest, int(match.group(1)))
+    return highest if taken else 0
+
+def allocate_slug(document, base, field='slug', collection=None):
+    """
+    Returns the first free slug based on ``base`` for ``field`` of
+    ``document`` class (stored in ``collection``): ``base`` if it is free,
+    otherwise ``base-<n>`` above the highest taken suffix. Empty ``base``
+    is replaced with the lower case name of the document class.
+    """
+    base = base or document.__name__.lower()
+    db_field = document._fields[field].db_field
+    if collection is None:
+        collection = document._get_collection()
+    highest = get_highest_slug_suffix(collection, db_field, base)
+    if not highest:
+        return base
+    return '%s-%s' % (base, highest + 1)
+
+def save_with_unique_slug(instance, source_field, field='slug', save=None,
+                          retries=5, **kwargs):
+    """
+    Saves ``instance`` with ``save`` (``instance.save`` by default) and
+    ``kwargs``, setting its empty ``field`` to a free slug of the value of
+    ``source_field``.
+
+    The ``field`` should have a unique index: if the allocated slug is
+    taken concurrently, `NotUniqueError` is caught and the slug is
+    allocated again (at most ``retries`` times). So saving costs two
+    round trips unless there is contention. As ``save`` may be called
+    again, it must only save the document (e.g. files saved by forms
+    are written before, see `mongotools.forms.save_with_files`).
+    """
+    save = save or instance.save
+    if instance[field]:
+        return save(**kwargs)
+    document = type(instance)
+    base = slugify(unicode(instance[source_field] or ''))
+    db_field = document._fields[field].db_field
+    for attempt in range(retries + 1):
+        instance[field] = allocate_slug(document, base, field,
+                                        instance._get_collection())
+        try:
+            return save(**kwargs)
+        except NotUniqueError, e:
+            # other unique index violated or out of retries
+            if db_field not in unicode(e) or attempt == retries:
+                instance[field] = None
+                raise
+
+
+class UniqueSlugMixin(object):
+    """
+    Document mixin setting unique ``slug_field`` from ``slug_source_field``
+    on save, see `save_with_unique_slug`.
+    """
+    slug_field = 'slug'
+    slug_source_field = 'title'
+
+    def save(self, **kwargs):
+        return save_with_unique_slug(self, self.slug_source_field,
+                                     self.slug_field,
+                                     super(UniqueSlugMixin, self).save,
+                                     **kwargs)
@@ -0,0 +1,171 @@
+"""
+Routing of database aliases to tenant databases.
+
+The current tenant is a database alias set for the current thread, by
+`TenantMiddleware` or `tenant` context manager. While it is set, querysets
+of mongotools views and form fields, documents saved by forms and GridFS
+files saved by `save_file` use the tenant database instead of the alias
+configured for the document (or field). ``MONGOTOOLS_TENANT_ROUTER``
+setting may name a ``router(tenant_alias, alias)`` function returning the
+alias to use (e.g. to keep shared collections on their own alias).
+
+Tenant databases are registered with `register_tenant`, all of them share
+the connection pool of a single `MongoClient`.
+
+Documents routed with `route_document` are reloaded, updated and deleted
+in the tenant database, but mongoengine dereferences `ReferenceField`
+values from the database of the referenced document class. Use
+`get_reference` to load referenced documents of the current tenant.
+"""
+import threading
+
+from bson import DBRef
+from mongoengine import connection
+from mongoengine.connection import (get_db, get_connection,
+                                    DEFAULT_CONNECTION_NAME)
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+__all__ = ('register_tenant', 'get_tenant', 'set_tenant', 'tenant',
+           'route_alias', 'route_queryset', 'route_document', 'route_proxy',
+           'get_reference', 'TenantMiddleware')
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+
+def register_tenant(alias, db_name, connection_alias=DEFAULT_CONNECTION_NAME):
+    """
+    Registers ``alias`` of ``db_name`` database using the `MongoClient` (and
+    its connection pool) of ``connection_alias`` connection.
+    """
+    with _lock:
+        if alias in connection._connection_settings:
+            return
+        client = get_connection(connection_alias)
+        conn_settings = dict(connection._connection_settings[connection_alias])
+        conn_settings['name'] = db_name
+        connection._connection_settings[alias] = conn_settings
+        connection._connections[alias] = client
+
+def get_tenant():
+    """Returns database alias of the current tenant or ``None``."""
+    return getattr(_local, 'alias', None)
+
+def set_tenant(alias):
+    _local.alias = alias
+
+
+class tenant(object):
+    """Context manager setting the current tenant ``alias``."""
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def __enter__(self):
+        self.previous = get_tenant()
+        set_tenant(self.alias)
+
+    def __exit__(self, *exc_info):
+        set_tenant(self.previous)
+
+
+_router = None
+
+def get_router():
+    global _router
+    path = getattr(settings, 'MONGOTOOLS_TENANT_ROUTER', None)
+    if path and _router is None:
+        module_name, name = path.rsplit('.', 1)
+        _router = getattr(import_module(module_name), name)
+    return _router
+
+def route_alias(alias):
+    """Returns alias to use instead of ``alias`` for the current tenant."""
+    tenant_alias = get_tenant()
+    if tenant_alias is None:
+        return alias
+    router = get_router()
+    if router is not None:
+        return router(tenant_alias, alias) or alias
+    return tenant_alias
+
+def _get_document_alias(document):
+    return document._meta.get('db_alias') or DEFAULT_CONNECTION_NAME
+
+def route_queryset(queryset):
+    """Returns ``queryset`` reading from the current tenant database."""
+    document = queryset._document
+    document_alias = _get_document_alias(document)
+    alias = route_alias(document_alias)
+    if alias == document_alias:
+        return queryset
+    if hasattr(queryset, 'using'):
+        # mongoengine 0.9+
+        return queryset.using(alias)
+    queryset = queryset.clone()
+    queryset._collection_obj = get_db(alias)[document._get_collection_name()]
+    return queryset
+
+def route_document(doc):
+    """
+    Makes ``doc`` instance use the current tenant database. Like
+    `Document.switch_db`, but does not mark loaded documents as new.
+    """
+    document_alias = _get_document_alias(doc.__class__)
+    alias = route_alias(document_alias)
+    if alias != document_alias:
+        db = get_db(alias)
+        collection = db[doc._get_collection_name()]
+        doc._get_db = lambda: db
+        doc._get_collection = lambda: collection
+        doc._collection = collection
+    return doc
+
+def get_reference_id(doc, field_name):
+    """Returns id of document referenced by ``field_name`` of ``doc``."""
+    value = doc._data.get(field_name)
+    if isinstance(value, DBRef):
+        return value.id
+    return getattr(value, 'pk', value)
+
+def get_reference(doc, field_name):
+    """
+    Returns document referenced by `ReferenceField` ``field_name`` of
+    ``doc`` loaded from the current tenant database (or ``None``).
+    """
+    pk = get_reference_id(doc, field_name)
+    if pk is None:
+        return None
+    document = doc._fields[field_name].document_type
+    referenced = route_queryset(document.objects).filter(pk=pk).first()
+    return route_document(referenced) if referenced is not None else None
+
+def route_proxy(proxy):
+    """Makes `GridFSProxy` use the current tenant database."""
+    alias = route_alias(proxy.db_alias)
+    if alias != proxy.db_alias:
+        # `GridFSProxy.__getattr__` would fetch the file
+        proxy.__dict__['db_alias'] = alias
+        proxy.__dict__['_fs'] = None
+    return proxy
+
+
+class TenantMiddleware(object):
+    """
+    Sets the current tenant for requests, by default by host name looked
+    up in ``MONGOTOOLS_TENANT_HOSTS`` setting (host -> alias dict).
+    """
+
+    def get_tenant(self, request):
+        hosts = getattr(settings, 'MONGOTOOLS_TENANT_HOSTS', {})
+        return hosts.get(request.get_host().split(':')[0])
+
+    def process_request(self, request):
+        set_tenant(self.get_tenant(request))
+
+    def process_response(self, request, response):
+        set_tenant(None)
+        return response
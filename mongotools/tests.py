@@ -0,0 +1,245 @@
+"""
+Tests of mongotools. They need a MongoDB server on ``MONGOTOOLS_TEST_HOST``
+(``localhost`` by default) and are skipped if it is not available.
+"""
+import os
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+
+from gridfs import GridFS
+from mongoengine import Document, connect
+from mongoengine.connection import get_db, get_connection
+from mongoengine.fields import (StringField, FileField, ImageField,
+                                IntField)
+
+from django.utils import unittest
+
+from mongotools.forms.widgets import ClearableGridFSFileInput
+from mongotools import renditions
+from mongotools.compat import update_many
+from mongotools.forms import DocumentForm
+from mongotools.forms.utils import _get_unique_filename
+from mongotools.orphans import (release_document_files,
+                                collect_orphaned_files)
+from mongotools.slugs import allocate_slug
+from mongotools.tenancy import register_tenant, tenant, route_document
+from mongotools.views import StreamedObjectList, MongoFormMixin
+from mongotools.writebehind import WriteBehindQueue
+
+TEST_HOST = os.environ.get('MONGOTOOLS_TEST_HOST', 'localhost')
+TEST_DB = 'mongotools_test'
+TENANTS = ('mongotools_test_t1', 'mongotools_test_t2')
+
+
+
+class Note(Document):
+    title = StringField()
+    slug = StringField()
+
+    meta = {'collection': 'mongotools_test_note'}
+
+
+class Attachment(Document):
+    file = FileField()
+
+    meta = {'collection': 'mongotools_test_attachment'}
+
+
+class Photo(Document):
+    image = ImageField(thumbnail_size=(10, 10, True))
+
+    meta = {'collection': 'mongotools_test_photo'}
+
+
+class Page(Document):
+    title = StringField()
+    slug = StringField()
+    version = IntField(default=0)
+
+    meta = {'collection': 'mongotools_test_page'}
+
+
+class PageForm(DocumentForm):
+
+    class Meta:
+        document = Page
+        fields = ('title',)
+        version_field = 'version'
+
+
+class MongoTestCase(unittest.TestCase):
+    """Connects the default alias and tenants to test databases."""
+
+    def setUp(self):
+        try:
+            connect(TEST_DB, host=TEST_HOST)
+            get_connection().server_info()
+        except Exception, e:
+            raise unittest.SkipTest('MongoDB is not available: %s' % e)
+        for alias in TENANTS:
+            register_tenant(alias, alias)
+
+    def tearDown(self):
+        client = get_connection()
+        for name in (TEST_DB,) + TENANTS:
+            client.drop_database(name)
+
+
+class WriteBehindQueueTest(MongoTestCase):
+
+    def test_tenant_collections(self):
+        queue = WriteBehindQueue()
+        for alias in TENANTS:
+            with tenant(alias):
+                queue.put(route_document(Note(title=alias)))
+        queue.flush()
+        for alias in TENANTS:
+            titles = [n['title'] for n in
+                      get_db(alias)[Note._get_collection_name()].find()]
+            self.assertEqual(titles, [alias])
+
+
+class TenantFilesTest(MongoTestCase):
+
+    def load_attachment(self, alias):
+        grid_id = GridFS(get_db(alias)).put('data', filename='a.txt')
+        return Attachment._from_son({'_id': grid_id, 'file': grid_id})
+
+    def test_file_widget(self):
+        with tenant(TENANTS[0]):
+            doc = self.load_attachment(TENANTS[0])
+            initial = ClearableGridFSFileInput().get_proxy_initial(doc.file)
+        self.assertEqual(initial, u'a.txt')
+
+    def test_release_document_files(self):
+        with tenant(TENANTS[0]):
+            doc = self.load_attachment(TENANTS[0])
+            grid_id = doc.file.grid_id
+            release_document_files(doc)
+        self.assertFalse(GridFS(get_db(TENANTS[0])).exists(grid_id))
+
+
+class StreamedObjectListTest(MongoTestCase):
+
+    def test_sliced_count(self):
+        for i in range(25):
+            Note(title=str(i)).save()
+        rows = StreamedObjectList(Note.objects.order_by('id'))[20:30]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual([row['title'] for row in rows], map(str, range(20, 25)))
+        self.assertFalse(StreamedObjectList(Note.objects)[30:40])
+
+
+class AllocateSlugTest(MongoTestCase):
+
+    def allocate(self, base, *taken):
+        for slug in taken:
+            Note(slug=slug).save()
+        return allocate_slug(Note, base)
+
+    def test_free_base(self):
+        self.assertEqual(self.allocate('foo', 'foo-2019', 'foobar'), 'foo')
+
+    def test_taken_base(self):
+        self.assertEqual(self.allocate('foo', 'foo', 'foo-3'), 'foo-4')
+        self.assertEqual(self.allocate('bar', 'bar'), 'bar-2')
+
+    def test_empty_base(self):
+        self.assertEqual(self.allocate('', ''), 'note')
+        self.assertEqual(self.allocate('', 'note'), 'note-2')
+
+
+class StaticPreset(renditions.RenditionPreset):
+
+    def render(self, data):
+        return 'rendition', 'image/png'
+
+
+class GenerateRenditionTest(MongoTestCase):
+
+    def setUp(self):
+        super(GenerateRenditionTest, self).setUp()
+        self.presets = renditions._presets
+        renditions._presets = {'thumb': StaticPreset('thumb', (10, 10))}
+        renditions._indexed_collections.clear()
+
+    def tearDown(self):
+        renditions._presets = self.presets
+        renditions._indexed_collections.clear()
+        super(GenerateRenditionTest, self).tearDown()
+
+    def test_concurrent_generation(self):
+        source_id = GridFS(get_db()).put('image', filename='a.png')
+        collection, fs = renditions._get_renditions_fs('default', 'fs')
+        # stored by another process while this one was rendering
+        stored_id = fs.put('rendition', source_id=source_id, preset='thumb')
+        self.assertEqual(renditions.generate_rendition(
+            'default', 'fs', source_id, 'thumb'), stored_id)
+        self.assertEqual(collection.files.count(), 1)
+        self.assertEqual(collection.chunks.find(
+            {'files_id': {'$ne': stored_id}}).count(), 0)
+
+
+class VersionedSaveTest(MongoTestCase):
+
+    def get_form(self):
+        page = Page(title='Old').save()
+        form = PageForm({'title': 'New', 'version': '0'}, instance=page)
+        self.assertTrue(form.is_valid())
+        return form
+
+    def test_slug_save_conflict(self):
+        form = self.get_form()
+        # changed by another request
+        Page.objects(pk=form.instance.pk).update(set__version=1)
+        view = type('PageView', (MongoFormMixin,),
+                    {'slug_source_field': 'title'})()
+        self.assertEqual(view.save_form(form), None)
+        self.assertTrue(form.non_field_errors())
+        self.assertEqual(Page.objects.get(pk=form.instance.pk).title, 'Old')
+
+    def test_unacknowledged_save(self):
+        form = self.get_form()
+        self.assertRaises(ValueError, form.save, write_concern={'w': 0})
+
+
+class CollectOrphanedFilesTest(MongoTestCase):
+
+    def test_image_thumbnails(self):
+        if renditions.Image is None:
+            raise unittest.SkipTest('PIL is not available')
+        data = StringIO()
+        renditions.Image.new('RGB', (50, 50)).save(data, 'PNG')
+        photo = Photo()
+        photo.image.put(StringIO(data.getvalue()))
+        photo.save()
+        fs = GridFS(get_db(), 'images')
+        orphan_id = fs.put('orphan')
+        thumbnail_id = photo.image.thumbnail._id
+        update_many(get_db().images.files, {}, {'$set': {
+            'uploadDate': datetime.utcnow() - timedelta(days=2)}})
+
+        deleted = collect_orphaned_files(collection_name='images',
+                                         documents=[Photo], dry_run=False)
+        self.assertEqual(deleted, [orphan_id])
+        self.assertTrue(fs.exists(photo.image.grid_id))
+        self.assertTrue(fs.exists(thumbnail_id))
+
+
+class UniqueFilenameTest(MongoTestCase):
+
+    def allocate(self, name, *taken):
+        fs = GridFS(get_db())
+        for filename in taken:
+            fs.put('data', filename=filename)
+        return _get_unique_filename(Attachment().file, name)
+
+    def test_free_name(self):
+        self.assertEqual(self.allocate('report.pdf', 'report_2019.pdf'),
+                         'report.pdf')
+        self.assertEqual(self.allocate('report.pdf'), 'report_2020.pdf')
+
+    def test_taken_name(self):
+        self.assertEqual(self.allocate('report.pdf', 'report.pdf',
+                                       'report_3.pdf'), 'report_4.pdf')
+        self.assertEqual(self.allocate('report.pdf'), 'report_5.pdf')
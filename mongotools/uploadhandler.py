@@ -0,0 +1,108 @@
+import hashlib
+
+from gridfs import GridFS
+from mongoengine.connection import get_db, DEFAULT_CONNECTION_NAME
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from mongotools.compat import update_one
+from mongotools.tenancy import route_alias
+
+__all__ = ('GridFSUploadHandler', 'GridFSUploadedFile')
+
+# files collection key of uploaded files not saved to any document yet
+PENDING_KEY = 'mongotools_pending'
+
+
+
+class GridFSUploadedFile(UploadedFile):
+    """
+    A file uploaded directly into GridFS by `GridFSUploadHandler`.
+
+    The file content is read lazily from GridFS. `save_file` assigns
+    the stored file to the document field without copying it.
+    """
+
+    def __init__(self, grid_out, name, content_type, size, charset,
+                 db_alias, collection_name, sha256=None):
+        super(GridFSUploadedFile, self).__init__(grid_out, name, content_type,
+                                                 size, charset)
+        self.grid_id = grid_out._id
+        self.sha256 = sha256
+        self.db_alias = db_alias
+        self.collection_name = collection_name
+
+    def is_stored_for(self, proxy):
+        """
+        Returns ``True`` if the file is stored in the GridFS collection
+        used by ``proxy``.
+        """
+        return (proxy.db_alias == self.db_alias and
+                proxy.collection_name == self.collection_name)
+
+    def store(self, filename, **attrs):
+        """
+        Renames the stored file to ``filename`` (and sets other ``fs.files``
+        ``attrs``) marking it as not pending anymore.
+        """
+        attrs['filename'] = filename
+        files = get_db(self.db_alias)[self.collection_name].files
+        update_one(files, {'_id': self.grid_id},
+                   {'$set': attrs, '$unset': {PENDING_KEY: 1}})
+
+    def discard(self):
+        """Deletes the stored file (e.g. if the form is not valid)."""
+        GridFS(get_db(self.db_alias), self.collection_name).delete(self.grid_id)
+
+
+class GridFSUploadHandler(FileUploadHandler):
+    """
+    File upload handler streaming uploaded chunks straight into GridFS,
+    so uploads are neither buffered in memory nor written to temporary
+    files.
+
+    Files are stored in the ``MONGOTOOLS_UPLOAD_DB_ALIAS`` database
+    (``default`` by default) and ``MONGOTOOLS_UPLOAD_COLLECTION``
+    collection (``fs`` by default). Files which are not saved to a document
+    stay marked as pending and should be removed by the orphaned files
+    collector or with `GridFSUploadedFile.discard`.
+    """
+
+    def __init__(self, request=None, db_alias=None, collection_name=None):
+        super(GridFSUploadHandler, self).__init__(request)
+        self.db_alias = route_alias(db_alias or getattr(
+            settings, 'MONGOTOOLS_UPLOAD_DB_ALIAS', DEFAULT_CONNECTION_NAME))
+        self.collection_name = collection_name or getattr(
+            settings, 'MONGOTOOLS_UPLOAD_COLLECTION', 'fs')
+        self.grid_in = None
+        self.sha = None
+
+    def new_file(self, *args, **kwargs):
+        super(GridFSUploadHandler, self).new_file(*args, **kwargs)
+        fs = GridFS(get_db(self.db_alias), self.collection_name)
+        self.grid_in = fs.new_file(filename=self.file_name,
+                                   content_type=self.content_type,
+                                   **{PENDING_KEY: True})
+        self.sha = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.grid_in.write(raw_data)
+        self.sha.update(raw_data)
+        # do not pass data to other handlers
+
+    def file_complete(self, file_size):
+        self.grid_in.close()
+        fs = GridFS(get_db(self.db_alias), self.collection_name)
+        grid_out = fs.get(self.grid_in._id)
+        self.grid_in = None
+        return GridFSUploadedFile(grid_out, self.file_name, self.content_type,
+                                  file_size, self.charset, self.db_alias,
+                                  self.collection_name, self.sha.hexdigest())
+
+    def upload_interrupted(self):
+        # Django 1.7+
+        if self.grid_in is not None and hasattr(self.grid_in, 'abort'):
+            self.grid_in.abort()
+        self.grid_in = None
@@ -20,16 +20,54 @@
 # This file is based in Django Class Views
 # adapted for use of mongoengine
 
+import re
+import calendar
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs import GridFS
+from gridfs.errors import NoFile
+from mongoengine import NotUniqueError
+from mongoengine.connection import get_db, DEFAULT_CONNECTION_NAME
+
 from django.views.generic.detail import SingleObjectMixin, BaseDetailView
 from django.views.generic.edit import FormMixin, ProcessFormView, DeletionMixin
-from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.exceptions import (ImproperlyConfigured, ObjectDoesNotExist,
+                                    NON_FIELD_ERRORS)
 from django.utils.encoding import smart_str
 from django.views.generic.base import TemplateResponseMixin, View
-from django.http import HttpResponseRedirect, Http404
+from django.http import (HttpResponse, HttpResponseRedirect,
+                         HttpResponseNotModified, Http404)
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5
+    StreamingHttpResponse = HttpResponse
+from django.utils.http import http_date
+from django.views.static import was_modified_since
 from django.views.generic.list import MultipleObjectMixin, BaseListView
 from django.shortcuts import render
 from django.contrib import messages
 
+from mongotools.compat import count_sliced, write_concern_kwargs
+from mongotools.facets import get_facet_counts
+from mongotools.filters import (check_filter_indexes, compile_filters,
+                                compile_search)
+from mongotools.indexadvisor import collect_queryset, get_source_name
+from mongotools.filecache import get_default_file_cache
+from mongotools.forms import save_with_files, VersionConflict
+from mongotools.forms.serializers import (MongoJSONEncoder,
+                                          documentserializer_factory)
+from mongotools.orphans import release_document_files
+from mongotools.renditions import get_preset, get_rendition, schedule_rendition
+from mongotools.slugs import save_with_unique_slug
+from mongotools.tenancy import (route_alias, route_document, route_proxy,
+                                route_queryset)
+
 class MongoSingleObjectMixin(SingleObjectMixin):
     """
     Provides the ability to retrieve a single object for further manipulation.
@@ -60,12 +98,14 @@ class MongoSingleObjectMixin(SingleObjectMixin):
                                  u"either an object pk or a slug."
                                  % self.__class__.__name__)
 
+        collect_queryset(get_source_name(self), queryset)
         try:
             obj = queryset.get()
         except queryset._document.DoesNotExist:
             raise Http404(u"No %(verbose_name)s found matching the query" %
                           {'verbose_name': queryset._document.__name__})
-        return obj
+        # saved to the same tenant database
+        return route_document(obj)
 
     def get_queryset(self):
         """
@@ -74,14 +114,14 @@ class MongoSingleObjectMixin(SingleObjectMixin):
         """
         if self.queryset is None:
             if self.document:
-                return self.document.objects
+                return route_queryset(self.document.objects)
             else:
                 raise ImproperlyConfigured(u"%(cls)s is missing a queryset. Define "
                                            u"%(cls)s.document, %(cls)s.queryset, or override "
                                            u"%(cls)s.get_object()." % {
                                                 'cls': self.__class__.__name__
                                         })
-        return self.queryset.clone()
+        return route_queryset(self.queryset.clone())
 
     def get_context_object_name(self, obj):
         """
@@ -95,10 +135,78 @@ class MongoSingleObjectMixin(SingleObjectMixin):
             return None
 
         
-class MongoMultipleObjectMixin(MultipleObjectMixin):
+class StreamedObjectList(object):
+    """
+    Iterable of read-only rows (dicts of python values keyed by field
+    names, plus ``pk``) of documents matching ``queryset``.
+
+    Documents are read from the raw cursor in batches of ``batch_size`` and
+    neither cached nor turned into document instances (references are not
+    dereferenced), so memory used by iteration does not depend on the
+    number of documents. Every iteration runs the query again. Use
+    `QuerySet.only` to fetch fewer fields.
+    """
+
+    def __init__(self, queryset, batch_size=500):
+        self.queryset = queryset
+        self.batch_size = batch_size
+        self._document = queryset._document
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = count_sliced(self.queryset)
+        return self._count
+
+    def __len__(self):
+        # used by templates instead of consuming the iterator into a list
+        return self.count()
+
+    def __nonzero__(self):
+        return self.count() > 0
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            # pages of `Paginator`
+            return StreamedObjectList(self.queryset[key], self.batch_size)
+        for row in StreamedObjectList(self.queryset[key:key + 1]):
+            return row
+        raise IndexError(key)
+
+    def __iter__(self):
+        fields = [(name, f.db_field, f)
+                  for name, f in self._document._fields.items()]
+        id_field = self._document._meta['id_field']
+        cursor = self.queryset.clone()._cursor.batch_size(self.batch_size)
+        for son in cursor:
+            row = {}
+            for name, db_field, f in fields:
+                if db_field in son:
+                    row[name] = f.to_python(son[db_field])
+            row['pk'] = row.get(id_field)
+            yield row
+
 
+class MongoMultipleObjectMixin(MultipleObjectMixin):
+    """
+    Objects may be filtered by GET parameters named like ``filter_fields``
+    lookups (e.g. ``author`` or ``datetime_added__gte``) and searched for
+    ``search_param`` parameter in ``search_fields``. Filters not supported
+    by indexes raise `ImproperlyConfigured` (or just warn if
+    ``unindexed_filters`` is ``'warn'``), see `mongotools.filters`.
+
+    If ``stream_object_list`` is true, the object list is a
+    `StreamedObjectList` of read-only rows fetched in batches of
+    ``stream_batch_size`` documents.
+    """
     document = None
-    
+    filter_fields = ()
+    search_fields = ()
+    search_param = 'q'
+    unindexed_filters = 'error'
+    stream_object_list = False
+    stream_batch_size = 500
+
     def get_queryset(self):
         """
         Get the list of items for this view. This must be an interable, and may
@@ -113,6 +221,28 @@ class MongoMultipleObjectMixin(MultipleObjectMixin):
         else:
             raise ImproperlyConfigured(u"'%s' must define 'queryset' or 'document'"
                                        % self.__class__.__name__)
+        if hasattr(queryset, '_document'):
+            queryset = route_queryset(queryset)
+        if self.filter_fields or self.search_fields:
+            queryset = self.filter_queryset(queryset)
+        if hasattr(queryset, '_document'):
+            collect_queryset(get_source_name(self), queryset)
+        if self.stream_object_list:
+            queryset = StreamedObjectList(queryset, self.stream_batch_size)
+        return queryset
+
+    def filter_queryset(self, queryset):
+        document = queryset._document
+        text_index = check_filter_indexes(document, self.filter_fields,
+                                          self.search_fields,
+                                          self.unindexed_filters)
+        query, self.filter_errors = compile_filters(
+            document, self.filter_fields, self.request.GET)
+        queryset = queryset.filter(**query)
+        text = self.request.GET.get(self.search_param)
+        if text and self.search_fields:
+            queryset = queryset.filter(compile_search(
+                document, self.search_fields, text, text_index))
         return queryset
 
 class MongoSingleObjectTemplateResponseMixin(TemplateResponseMixin):
@@ -157,7 +287,19 @@ class MongoSingleObjectTemplateResponseMixin(TemplateResponseMixin):
 class MongoFormMixin(FormMixin, MongoSingleObjectMixin):
     """
     A mixin that provides a way to show and handle a mongoform in a request.
+
+    If ``slug_source_field`` is set, an empty ``slug_field`` of the saved
+    object is set to a unique slug of that field, see
+    `mongotools.slugs.save_with_unique_slug`.
+
+    Objects are saved with ``write_concern`` (e.g. ``{'w': 0}`` for
+    fire-and-forget saves) or, if ``write_behind`` (a
+    `mongotools.writebehind.WriteBehindQueue`) is set, new objects are
+    queued for batched insert.
     """
+    slug_source_field = None
+    write_concern = None
+    write_behind = None
 
     def get_form_class(self):
         """
@@ -191,8 +333,37 @@ class MongoFormMixin(FormMixin, MongoSingleObjectMixin):
                     " a get_absolute_url method on the Document.")
         return url
 
+    def save_form(self, form):
+        kwargs = {}
+        if self.write_concern is not None:
+            kwargs['write_concern'] = self.write_concern
+        if self.write_behind is not None and self.object is None:
+            kwargs['write_behind'] = self.write_behind
+        if not self.slug_source_field:
+            return form.save(**kwargs)
+        if 'write_behind' in kwargs:
+            raise ImproperlyConfigured(u"Unique slugs can not be allocated"
+                                       u" for queued objects")
+        instance = form.save(commit=False)
+        # form files are written once, only the document save (checking
+        # its version) is retried, validation is already done by the form
+        try:
+            return save_with_files(
+                instance.save_files, save_with_unique_slug, instance,
+                self.slug_source_field, self.slug_field,
+                instance.save_document, validate=False,
+                **write_concern_kwargs(self.write_concern))
+        except NotUniqueError, e:
+            form._update_errors({NON_FIELD_ERRORS: [e.message]})
+            return None
+        except VersionConflict:
+            form._update_errors({NON_FIELD_ERRORS: [
+                form.version_conflict_message % {
+                    'document_name': instance.__class__.__name__}]})
+            return None
+
     def form_valid(self, form):
-        instance = form.save()
+        instance = self.save_form(form)
         if instance is None:
             # see `BaseDocumentForm.save`
             return super(MongoFormMixin, self).form_invalid(form)
@@ -237,6 +408,9 @@ class BaseUpdateView(MongoFormMixin, ProcessFormView):
     """
     Base view for updating an existing object.
 
+    Concurrent updates are detected if the form class has
+    ``Meta.version_field``, see `mongotools.forms.save_versioned`.
+
     Using this base class requires subclassing to provide a response mixin.
     """
     def get(self, request, *args, **kwargs):
@@ -260,7 +434,18 @@ class BaseDeleteView(DeletionMixin, BaseDetailView):
     """
     Base view for deleting an object.
     Using this base class requires subclassing to provide a response mixin.
+
+    Files of the deleted object are released too, unless ``delete_files``
+    is false.
     """
+    delete_files = True
+
+    def delete(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        self.object.delete()
+        if self.delete_files:
+            release_document_files(self.object)
+        return HttpResponseRedirect(self.get_success_url())
 
 class DeleteView(MongoSingleObjectTemplateResponseMixin, BaseDeleteView):
     """
@@ -304,3 +489,336 @@ class ListView(MongoMultipleObjectTemplateResponseMixin, BaseListView):
     Render some list of objects, set by `self.model` or `self.queryset`.
     `self.queryset` can actually be any iterable of items, not just a queryset.
     """
+
+class FacetedListView(ListView):
+    """
+    List view which also provides counts of ``facets`` (e.g.
+    `mongotools.facets.TermsFacet` instances) for the whole object list in
+    ``facets`` context variable, see `mongotools.facets.get_facet_counts`.
+    """
+    facets = ()
+    facets_cache_timeout = 60 * 5
+
+    def get_facets(self):
+        return self.facets
+
+    def get_context_data(self, **kwargs):
+        context = super(FacetedListView, self).get_context_data(**kwargs)
+        queryset = self.object_list
+        if isinstance(queryset, StreamedObjectList):
+            queryset = queryset.queryset
+        context['facets'] = get_facet_counts(queryset, self.get_facets(),
+                                             self.facets_cache_timeout)
+        return context
+
+
+class JSONResponseMixin(object):
+    """
+    A mixin that renders data to a JSON response.
+    """
+    json_encoder = MongoJSONEncoder
+    json_content_type = 'application/json'
+
+    def render_to_json_response(self, data, status=200):
+        return HttpResponse(json.dumps(data, cls=self.json_encoder),
+                            content_type=self.json_content_type,
+                            status=status)
+
+
+# document -> serializer class generated by `BaseJSONFormView`
+_serializer_classes = {}
+
+class BaseJSONFormView(JSONResponseMixin, MongoSingleObjectMixin, View):
+    """
+    Base view for processing JSON request bodies with a `DocumentSerializer`.
+
+    Objects are saved with ``write_concern``, see `MongoFormMixin`.
+    """
+    form_class = None
+    success_status = 200
+    write_concern = None
+
+    def get_form_class(self):
+        if self.form_class:
+            return self.form_class
+        if self.document is None:
+            raise ImproperlyConfigured(u"%s must define 'form_class' or"
+                                       u" 'document'" % self.__class__.__name__)
+        serializer = _serializer_classes.get(self.document)
+        if serializer is None:
+            serializer = documentserializer_factory(self.document)
+            _serializer_classes[self.document] = serializer
+        return serializer
+
+    def get_request_data(self):
+        request = self.request
+        body = getattr(request, 'body', None)
+        if body is None:
+            # Django < 1.4
+            body = request.raw_post_data
+        data = json.loads(body or '{}')
+        if not isinstance(data, dict):
+            raise ValueError('JSON object expected')
+        return data
+
+    def get_form(self, form_class, partial=False):
+        return form_class(data=self.get_request_data(), instance=self.object,
+                          partial=partial)
+
+    def process_form(self, partial=False):
+        form_class = self.get_form_class()
+        try:
+            form = self.get_form(form_class, partial)
+        except ValueError, e:
+            # malformed JSON
+            return self.render_to_json_response(
+                {'errors': {NON_FIELD_ERRORS: [unicode(e)]}}, status=400)
+        if form.is_valid():
+            return self.form_valid(form)
+        return self.form_invalid(form)
+
+    def form_valid(self, form):
+        instance = form.save(write_concern=self.write_concern)
+        if instance is None:
+            # see `BaseDocumentForm.save`
+            return self.form_invalid(form)
+        self.object = instance
+        return self.render_to_json_response(form.to_data(),
+                                            status=self.success_status)
+
+    def form_invalid(self, form):
+        return self.render_to_json_response({'errors': form.get_error_dict()},
+                                            status=400)
+
+
+class JSONCreateView(BaseJSONFormView):
+    """
+    View for creating an new object instance from a JSON request body.
+    """
+    success_status = 201
+
+    def post(self, request, *args, **kwargs):
+        self.object = None
+        return self.process_form()
+
+
+class JSONUpdateView(BaseJSONFormView):
+    """
+    View for updating an existing object from a JSON request body.
+    ``PATCH`` requests update only the fields present in the body.
+    """
+    if 'patch' not in View.http_method_names:
+        # Django < 1.5
+        http_method_names = View.http_method_names + ['patch']
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        form = self.get_form_class()(instance=self.object)
+        return self.render_to_json_response(form.to_data())
+
+    def put(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return self.process_form()
+
+    def patch(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return self.process_form(partial=True)
+
+    post = put
+
+
+class GridFSFileView(MongoSingleObjectMixin, View):
+    """
+    Serves a GridFS file.
+
+    The file is looked up by ``file_id`` URL argument in ``collection_name``
+    GridFS collection of ``db_alias`` database, or, if ``file_field`` is set,
+    taken from that field of the document found by `get_object`.
+
+    The content is streamed in GridFS chunks, single byte range requests
+    (``Range``, ``If-Range``) and conditional requests (``If-None-Match``,
+    ``If-Modified-Since``) are supported.
+
+    Files are served from ``file_cache`` (`mongotools.filecache.LocalFileCache`
+    configured with ``MONGOTOOLS_FILE_CACHE`` setting by default) if it is
+    enabled and the file is not too large.
+    """
+    db_alias = DEFAULT_CONNECTION_NAME
+    collection_name = 'fs'
+    file_id_url_kwarg = 'file_id'
+    file_field = None
+    file_cache = None
+    as_attachment = False
+    default_content_type = 'application/octet-stream'
+
+    range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+    def get_file(self):
+        """Returns `GridOut` instance of the file to serve."""
+        if self.file_field:
+            proxy = self.proxy = self.get_object()[self.file_field]
+            if not proxy:
+                raise Http404(u"No file found")
+            grid_out = route_proxy(proxy).get()
+            if not grid_out:
+                raise Http404(u"No file found")
+            return grid_out
+        try:
+            file_id = ObjectId(self.kwargs.get(self.file_id_url_kwarg))
+            fs = GridFS(get_db(route_alias(self.db_alias)),
+                        self.collection_name)
+            return fs.get(file_id)
+        except (InvalidId, TypeError, NoFile):
+            raise Http404(u"No file found")
+
+    def get_etag(self, grid_out):
+        md5 = getattr(grid_out, 'md5', None)
+        if md5:
+            return '"%s"' % md5
+        return '"%s-%s"' % (grid_out._id, self.get_last_modified(grid_out))
+
+    def get_last_modified(self, grid_out):
+        return int(calendar.timegm(grid_out.upload_date.utctimetuple()))
+
+    def get_range(self, length):
+        """
+        Returns ``(start, end)`` tuple (``end`` is inclusive) of the
+        requested range, ``None`` if the whole file is requested or
+        ``False`` if the range is not satisfiable.
+        """
+        match = self.range_re.match(self.request.META.get('HTTP_RANGE', ''))
+        if not match:
+            # no, multiple or malformed ranges
+            return None
+        start, end = match.groups()
+        if not start:
+            if not end:
+                return None
+            # suffix range
+            start, end = max(length - int(end), 0), length - 1
+        else:
+            start = int(start)
+            end = min(int(end), length - 1) if end else length - 1
+        if start >= length or start > end:
+            return False
+        return start, end
+
+    def stream(self, grid_out, start, length):
+        """Yields ``length`` bytes of the file starting at ``start``."""
+        grid_out.seek(start)
+        chunk_size = grid_out.chunk_size
+        while length > 0:
+            data = grid_out.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+    def get_file_cache(self):
+        if self.file_cache is not None:
+            return self.file_cache
+        return get_default_file_cache()
+
+    def get_content_response(self, grid_out, start, length, status=200):
+        """
+        Returns a response with ``length`` bytes of the file starting at
+        ``start``, served from the local file cache if possible.
+        """
+        cache = self.get_file_cache()
+        if cache is None or not cache.accepts(grid_out):
+            return StreamingHttpResponse(self.stream(grid_out, start, length),
+                                         status=status)
+        path, f = cache.open(grid_out)
+        if status == 200:
+            response = cache.sendfile_response(path, f)
+            if response is not None:
+                return response
+        return StreamingHttpResponse(cache.stream(f, start, length),
+                                     status=status)
+
+    def get(self, request, *args, **kwargs):
+        grid_out = self.get_file()
+        etag = self.get_etag(grid_out)
+        last_modified = self.get_last_modified(grid_out)
+        size = grid_out.length
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            if etag in [t.strip() for t in if_none_match.split(',')] or \
+                    if_none_match.strip() == '*':
+                return HttpResponseNotModified()
+        elif not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                    last_modified, size):
+            return HttpResponseNotModified()
+
+        byte_range = None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is None or if_range.strip() == etag:
+            byte_range = self.get_range(size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+
+        if byte_range:
+            start, end = byte_range
+            response = self.get_content_response(
+                grid_out, start, end - start + 1, status=206)
+            response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            response = self.get_content_response(grid_out, 0, size)
+            response['Content-Length'] = str(size)
+
+        response['Content-Type'] = (grid_out.content_type or
+                                    self.default_content_type)
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        if self.as_attachment and grid_out.filename:
+            response['Content-Disposition'] = 'attachment; filename="%s"' % (
+                smart_str(grid_out.filename).replace('"', ''))
+        return response
+
+
+class RenditionView(GridFSFileView):
+    """
+    Serves a rendition (resized variant) of a GridFS image for ``preset``
+    URL argument, see `mongotools.renditions`.
+
+    Missing renditions are scheduled for background generation and the
+    original image is served meanwhile with caching disabled. Generated
+    renditions never change, so they are served with ``cache_max_age``.
+    """
+    preset_url_kwarg = 'preset'
+    cache_max_age = 60 * 60 * 24 * 30
+
+    def get_file(self):
+        source = super(RenditionView, self).get_file()
+        try:
+            preset = get_preset(self.kwargs.get(self.preset_url_kwarg))
+        except ValueError:
+            raise Http404(u"No rendition preset found")
+        db_alias, collection_name = self.get_source_collection(source)
+        rendition = get_rendition(db_alias, collection_name, source._id,
+                                  preset.name)
+        self.is_rendition = rendition is not None
+        if rendition is None:
+            schedule_rendition(db_alias, collection_name, source._id,
+                               preset.name)
+            return source
+        return rendition
+
+    def get_source_collection(self, source):
+        if self.file_field:
+            # set by `GridFSFileView.get_file`
+            return self.proxy.db_alias, self.proxy.collection_name
+        return route_alias(self.db_alias), self.collection_name
+
+    def get(self, request, *args, **kwargs):
+        response = super(RenditionView, self).get(request, *args, **kwargs)
+        if self.is_rendition:
+            response['Cache-Control'] = 'max-age=%s' % self.cache_max_age
+        else:
+            response['Cache-Control'] = 'no-cache'
+        return response
@@ -0,0 +1,148 @@
+"""
+Warm-up of registered views and forms before worker processes are forked.
+
+Views and forms are registered with `register` (also usable as a class
+decorator) or listed by dotted path in ``MONGOTOOLS_WARMUP`` setting.
+`warm_up` builds their form classes, prefills shared option caches of
+`CachedSelect` widgets, loads their templates (kept by the cached template
+loader) and closes database connections, which must not be shared by
+forked processes. `warm_up_worker` opens the connections in the worker.
+With gunicorn ``--preload``::
+
+    # wsgi.py, after the application is created
+    from mongotools.warmup import warm_up
+    warm_up()
+
+    # gunicorn.conf.py
+    def post_fork(server, worker):
+        from mongotools.warmup import warm_up_worker
+        warm_up_worker()
+"""
+import logging
+
+from mongoengine import connection
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.template import TemplateDoesNotExist
+from django.template.loader import select_template
+from django.utils.importlib import import_module
+from django.views.generic.base import TemplateResponseMixin
+
+from mongotools.forms.widgets import CachedChoicesMixin
+
+__all__ = ('register', 'warm_up', 'warm_up_worker', 'close_connections')
+
+logger = logging.getLogger('mongotools.warmup')
+
+_registry = []
+
+
+
+def register(cls):
+    """Registers view or form class ``cls`` for warm-up."""
+    if cls not in _registry:
+        _registry.append(cls)
+    return cls
+
+def import_class(path):
+    module_name, name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), name)
+
+def get_registered():
+    classes = list(_registry)
+    for path in getattr(settings, 'MONGOTOOLS_WARMUP', ()):
+        cls = import_class(path)
+        if cls not in classes:
+            classes.append(cls)
+    return classes
+
+def make_view(view_class):
+    """Returns ``view_class`` instance set up for a bare GET request."""
+    from django.test.client import RequestFactory
+    view = view_class()
+    view.request = RequestFactory().get('/')
+    view.args = ()
+    view.kwargs = {}
+    return view
+
+def warm_up_form(form_class):
+    """Prefills option caches of form ``form_class``. Returns their number."""
+    count = 0
+    for field in form_class.base_fields.values():
+        widget = field.widget
+        if isinstance(widget, CachedChoicesMixin) and \
+                widget.get_choices_cache_key() is not None:
+            widget.render_options((), ())
+            count += 1
+    return count
+
+def warm_up_view(view_class, stats):
+    """Builds form class and loads templates of ``view_class``."""
+    view = make_view(view_class)
+    form_class = None
+    if getattr(view, 'form_class', None) or hasattr(view, 'process_form'):
+        try:
+            form_class = view.get_form_class()
+        except ImproperlyConfigured:
+            pass
+    if form_class is not None:
+        stats['forms'] += 1
+        stats['choices'] += warm_up_form(form_class)
+
+    if isinstance(view, TemplateResponseMixin):
+        view.object = None
+        if hasattr(view, 'paginate_by'):
+            # template names may depend on the object list
+            try:
+                view.object_list = view.get_queryset()
+            except Exception, e:
+                # e.g. unindexed filters, see `check_filter_indexes`
+                logger.exception('Object list of %s failed', view_class)
+                stats.setdefault('errors', []).append((view_class, e))
+                view.object_list = []
+        try:
+            select_template(view.get_template_names())
+            stats['templates'] += 1
+        except (ImproperlyConfigured, TemplateDoesNotExist):
+            pass
+
+def close_connections():
+    """Closes all connections, they are reopened on use."""
+    clients = dict((id(client), client)
+                   for client in connection._connections.values())
+    for client in clients.values():
+        client.close()
+
+def warm_up(classes=None):
+    """
+    Warms up ``classes`` (registered ones by default) and closes database
+    connections opened meanwhile. Returns a dict with numbers of warmed
+    up ``forms``, ``choices`` and ``templates`` and a list of ``(class,
+    exception)`` tuples of failed ``errors``.
+    """
+    stats = {'forms': 0, 'choices': 0, 'templates': 0, 'errors': []}
+    try:
+        for cls in classes or get_registered():
+            try:
+                if hasattr(cls, 'base_fields'):
+                    stats['forms'] += 1
+                    stats['choices'] += warm_up_form(cls)
+                else:
+                    warm_up_view(cls, stats)
+            except Exception, e:
+                # a broken class must not prevent warm-up of others
+                logger.exception('Warm-up of %s failed', cls)
+                stats['errors'].append((cls, e))
+    finally:
+        close_connections()
+    return stats
+
+def warm_up_worker():
+    """Connects to all configured databases (e.g. after fork)."""
+    clients = {}
+    for alias in connection._connection_settings.keys():
+        client = connection.get_connection(alias)
+        clients[id(client)] = client
+    for client in clients.values():
+        client.admin.command('ping')
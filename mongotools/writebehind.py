@@ -0,0 +1,161 @@
+import time
+import atexit
+import logging
+import threading
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+try:
+    from pymongo.errors import BulkWriteError
+except ImportError:
+    # pymongo < 2.7
+    BulkWriteError = None
+from mongoengine.fields import ObjectIdField
+
+from mongotools.compat import insert_many
+
+__all__ = ('WriteBehindQueue',)
+
+logger = logging.getLogger('mongotools.writebehind')
+
+
+
+class WriteBehindQueue(object):
+    """
+    Buffers new documents and inserts them with acknowledged unordered
+    ``insert_many`` calls, one per collection, every ``interval`` seconds
+    (from a background thread started with `start`) or as soon as
+    ``max_pending`` documents are buffered.
+
+    Documents get their ``ObjectId`` primary key when queued, so they can
+    be referenced (e.g. redirected to) before they are inserted. Insert
+    failures are logged to ``mongotools.writebehind`` logger and counted
+    in `metrics`; documents are neither validated nor signalled, so they
+    should be validated by a form first. ``on_success`` or ``on_failure``
+    callbacks passed to `put` are called once the insert is acknowledged
+    or failed (e.g. to commit or roll back saved files).
+
+    The queue is flushed on interpreter shutdown; documents buffered by a
+    killed process are lost.
+    """
+
+    def __init__(self, interval=1.0, max_pending=1000):
+        self.interval = interval
+        self.max_pending = max_pending
+        # (database name, collection name) -> (collection, list of SON
+        # documents, list of (on_success, on_failure) tuples)
+        self._pending = {}
+        self._pending_count = 0
+        self._lock = threading.Lock()
+        # serializes flushes, so inserts are not reordered
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._metrics = {'queued': 0, 'inserted': 0, 'failed': 0,
+                         'flushes': 0, 'last_flush_time': None}
+
+    def put(self, instance, on_success=None, on_failure=None):
+        """Queues insert of new document ``instance``."""
+        id_field = instance._meta['id_field']
+        if instance.pk is None and isinstance(instance._fields[id_field],
+                                              ObjectIdField):
+            instance.pk = ObjectId()
+        collection = instance._get_collection()
+        son = instance.to_mongo()
+        # collections of the same name in tenant databases are kept apart
+        key = (collection.database.name, collection.name)
+        with self._lock:
+            docs, callbacks = self._pending.setdefault(
+                key, (collection, [], []))[1:]
+            docs.append(son)
+            callbacks.append((on_success, on_failure))
+            self._pending_count += 1
+            self._metrics['queued'] += 1
+            full = self._pending_count >= self.max_pending
+        if full:
+            self.flush()
+        return instance
+
+    def flush(self):
+        """Inserts all buffered documents."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._pending_count = 0
+            if not pending:
+                return
+            started = time.time()
+            for collection, docs, callbacks in pending.values():
+                failed = self._insert(collection, docs)
+                with self._lock:
+                    self._metrics['inserted'] += len(docs) - len(failed)
+                    self._metrics['failed'] += len(failed)
+                for i, (on_success, on_failure) in enumerate(callbacks):
+                    callback = on_failure if i in failed else on_success
+                    if callback is None:
+                        continue
+                    try:
+                        callback()
+                    except Exception:
+                        logger.exception('Write-behind callback failed')
+            with self._lock:
+                self._metrics['flushes'] += 1
+                self._metrics['last_flush_time'] = time.time() - started
+
+    def _insert(self, collection, docs):
+        """Returns a set of indexes of ``docs`` which failed to insert."""
+        try:
+            insert_many(collection, docs, ordered=False)
+        except OperationFailure, e:
+            logger.exception('Write-behind insert into %s failed',
+                             collection.name)
+            if BulkWriteError is not None and isinstance(e, BulkWriteError):
+                return set(error['index'] for error in
+                           e.details.get('writeErrors', []))
+            # pymongo 2 does not report failed documents
+            ids = [son['_id'] for son in docs if '_id' in son]
+            inserted = set(son['_id'] for son in collection.find(
+                {'_id': {'$in': ids}}, {'_id': 1}))
+            return set(i for i, son in enumerate(docs)
+                       if son.get('_id') not in inserted)
+        except Exception:
+            logger.exception('Write-behind insert into %s failed',
+                             collection.name)
+            return set(range(len(docs)))
+        return set()
+
+    def metrics(self):
+        """
+        Returns a dict with ``queued``, ``inserted`` and ``failed`` document
+        counts, currently ``pending`` documents, number of ``flushes`` and
+        ``last_flush_time`` in seconds.
+        """
+        with self._lock:
+            metrics = dict(self._metrics, pending=self._pending_count)
+        return metrics
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Write-behind flush failed')
+
+    def start(self):
+        """Starts periodic flushing and flushing on shutdown."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='mongotools-writebehind')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stops periodic flushing and flushes buffered documents."""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()